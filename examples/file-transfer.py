@@ -8,6 +8,7 @@ import socket
 import os
 import sys
 import fcntl
+import hashlib
 import time
 
 from dbus import PROPERTIES_IFACE
@@ -20,12 +21,15 @@ from telepathy.interfaces import (CONN_INTERFACE,
 from telepathy.constants import (CONNECTION_HANDLE_TYPE_CONTACT, CONNECTION_STATUS_CONNECTING,
     CONNECTION_STATUS_CONNECTED, CONNECTION_STATUS_DISCONNECTED, SOCKET_ADDRESS_TYPE_UNIX,
     SOCKET_ACCESS_CONTROL_LOCALHOST, FILE_TRANSFER_STATE_NONE, FILE_TRANSFER_STATE_PENDING, FILE_TRANSFER_STATE_ACCEPTED,
-    FILE_TRANSFER_STATE_OPEN, FILE_TRANSFER_STATE_COMPLETED, FILE_TRANSFER_STATE_CANCELLED)
+    FILE_TRANSFER_STATE_OPEN, FILE_TRANSFER_STATE_COMPLETED, FILE_TRANSFER_STATE_CANCELLED,
+    FILE_HASH_TYPE_MD5)
 
 from account import connection_from_file
 
 loop = None
 
+CHUNK_SIZE = 64 * 1024
+
 
 ft_states = ['none', 'pending', 'accepted', 'open', 'completed', 'cancelled']
 
@@ -98,7 +102,8 @@ class FTClient(object):
         for path, props in channels:
             if props[CHANNEL + '.ChannelType'] == CHANNEL_TYPE_FILE_TRANSFER:
                 print "new FileTransfer channel"
-                self.ft_channel = Channel(self.conn.service_name, path)
+                self.ft_channel = Channel(self.conn.service_name, path,
+                    props=props)
 
                 self.ft_channel[CHANNEL_TYPE_FILE_TRANSFER].connect_to_signal('FileTransferStateChanged',
                         self.ft_state_changed_cb)
@@ -106,10 +111,12 @@ class FTClient(object):
                         self.ft_transferred_bytes_changed_cb)
                 self.ft_channel[CHANNEL_TYPE_FILE_TRANSFER].connect_to_signal('InitialOffsetDefined',
                         self.ft_initial_offset_defined_cb)
-                self.got_ft_channel()
 
                 self.file_name = props[CHANNEL_TYPE_FILE_TRANSFER + '.Filename']
                 self.file_size = props[CHANNEL_TYPE_FILE_TRANSFER + '.Size']
+                self.hash_type = props.get(CHANNEL_TYPE_FILE_TRANSFER + '.ContentHashType', 0)
+                self.content_hash = props.get(CHANNEL_TYPE_FILE_TRANSFER + '.ContentHash', '')
+                self.got_ft_channel()
 
     def ft_state_changed_cb(self, state, reason):
         print "file transfer is now in state %s" % ft_states[state]
@@ -121,6 +128,17 @@ class FTClient(object):
     def ft_initial_offset_defined_cb(self, offset):
         self.initial_offset = offset
 
+def md5_file(path):
+    md5 = hashlib.md5()
+    f = file(path, 'rb')
+    while True:
+        data = f.read(CHUNK_SIZE)
+        if not data:
+            break
+        md5.update(data)
+    f.close()
+    return md5.hexdigest()
+
 class FTReceiverClient(FTClient):
     def ready_cb(self, conn):
         FTClient.ready_cb(self, conn)
@@ -128,9 +146,16 @@ class FTReceiverClient(FTClient):
         print "waiting for file transfer offer"
 
     def got_ft_channel(self):
-        print "accept FT"
+        # what was received by an interrupted attempt is kept in a .part
+        # file, so only the rest has to be transferred again
+        self.part_path = os.path.join('/tmp', self.file_name + '.part')
+        offset = 0
+        if os.path.exists(self.part_path):
+            offset = min(os.path.getsize(self.part_path), self.file_size)
+
+        print "accept FT from offset %d" % offset
         self.sock_addr = self.ft_channel[CHANNEL_TYPE_FILE_TRANSFER].AcceptFile(
-            SOCKET_ADDRESS_TYPE_UNIX, SOCKET_ACCESS_CONTROL_LOCALHOST, "", 0,
+            SOCKET_ADDRESS_TYPE_UNIX, SOCKET_ACCESS_CONTROL_LOCALHOST, "", offset,
             byte_arrays=True)
 
     def ft_state_changed_cb(self, state, reason):
@@ -140,22 +165,39 @@ class FTReceiverClient(FTClient):
             s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
             s.connect(self.sock_addr)
 
-            path = self.create_output_path()
-            if self.initial_offset == 0:
-                out = file(path, 'w')
+            # the connection manager may not support the offset we asked for
+            if self.initial_offset == 0 or not os.path.exists(self.part_path):
+                out = file(self.part_path, 'wb')
             else:
-                out = file(path, 'a')
+                out = file(self.part_path, 'r+b')
+                out.seek(self.initial_offset)
+                out.truncate()
 
             # Set non-blocking
             fcntl.fcntl(out, fcntl.F_SETFL, os.O_NONBLOCK)
 
             read = self.initial_offset
             while read < self.file_size:
-                data = s.recv(self.file_size - read)
+                data = s.recv(min(CHUNK_SIZE, self.file_size - read))
+                if not data:
+                    print "transfer interrupted"
+                    break
                 read += len(data)
                 out.write(data)
 
             out.close()
+            if read < self.file_size:
+                print "run again to resume the transfer"
+                return
+
+            if self.hash_type == FILE_HASH_TYPE_MD5 and \
+                    md5_file(self.part_path) != self.content_hash.lower():
+                print "checksum mismatch, discarding the file"
+                os.unlink(self.part_path)
+                return
+
+            path = self.create_output_path()
+            os.rename(self.part_path, path)
             print "received file: %s" % path
 
     def create_output_path(self):
@@ -188,6 +230,7 @@ class FTSenderClient(FTClient):
         file_name = os.path.basename(self.file_to_offer)
         info = os.stat(self.file_to_offer)
         size = info.st_size
+        content_hash = md5_file(self.file_to_offer)
 
         # Request FT channel
         self.conn[CONNECTION_INTERFACE_REQUESTS].CreateChannel({
@@ -197,6 +240,8 @@ class FTSenderClient(FTClient):
             CHANNEL_TYPE_FILE_TRANSFER + '.ContentType': 'application/octet-stream',
             CHANNEL_TYPE_FILE_TRANSFER + '.Filename': file_name,
             CHANNEL_TYPE_FILE_TRANSFER + '.Size': size,
+            CHANNEL_TYPE_FILE_TRANSFER + '.ContentHashType': FILE_HASH_TYPE_MD5,
+            CHANNEL_TYPE_FILE_TRANSFER + '.ContentHash': content_hash,
             CHANNEL_TYPE_FILE_TRANSFER + '.Description': "I'm testing file transfer using Telepathy",
             CHANNEL_TYPE_FILE_TRANSFER + '.InitialOffset': 0})
 
@@ -217,7 +262,11 @@ class FTSenderClient(FTClient):
             f.seek(self.initial_offset)
 
             fcntl.fcntl(f, fcntl.F_SETFL, os.O_NONBLOCK)
-            s.send(f.read())
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                s.sendall(data)
             f.close()
 
 def usage():
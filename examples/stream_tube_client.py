@@ -85,7 +85,8 @@ class StreamTubeClient:
             CHANNEL_INTERFACE + ".TargetHandleType": CONNECTION_HANDLE_TYPE_ROOM,
             CHANNEL_INTERFACE + ".TargetID": self.muc_id})
 
-        self.channel_text = Channel(self.conn.dbus_proxy.bus_name, path)
+        self.channel_text = Channel(self.conn.dbus_proxy.bus_name, path,
+            props=props)
 
         self.self_handle = self.channel_text[CHANNEL_INTERFACE_GROUP].GetSelfHandle()
         self.channel_text[CHANNEL_INTERFACE_GROUP].connect_to_signal(
@@ -101,7 +102,8 @@ class StreamTubeClient:
 
         for path, props in channels:
             if props[CHANNEL_INTERFACE + ".ChannelType"] == CHANNEL_TYPE_STREAM_TUBE:
-                self.tube = Channel(self.conn.dbus_proxy.bus_name, path)
+                self.tube = Channel(self.conn.dbus_proxy.bus_name, path,
+                    props=props)
 
                 self.tube[CHANNEL_INTERFACE_TUBE].connect_to_signal(
                         "TubeChannelStateChanged", self.tube_channel_state_changed_cb)
@@ -221,13 +223,16 @@ class TrivialStream:
     def __init__(self, socket_address=None):
         self.socket_address = socket_address
 
-    def read_socket(self, s):
+    def read_socket(self, s, condition):
         try:
             data = s.recv(1024)
-            if len(data) > 0:
-                print "received:", data
         except socket.error, e:
-            pass
+            return True
+        if not data:
+            print "connection closed"
+            s.close()
+            return False
+        print "received:", data
         return True
 
     def write_socket(self, s, msg):
@@ -244,25 +249,23 @@ class TrivialStreamServer(TrivialStream):
 
     def run(self):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.setblocking(1)
-        s.settimeout(0.1)
+        s.setblocking(0)
         s.bind(("127.0.0.1", 0))
 
         self.socket_address = s.getsockname()
         print "Trivial Server lauched on socket", self.socket_address
         s.listen(1)
 
-        gobject.timeout_add(1000, self.accept_client, s)
+        gobject.io_add_watch(s, gobject.IO_IN, self.accept_client)
 
-    def accept_client(self, s):
+    def accept_client(self, s, condition):
         try:
             s2, addr = s.accept()
-            s2.setblocking(1)
-            s2.setblocking(0.1)
-            self.handle_client(s2)
-            return True
-        except socket.timeout:
+        except socket.error:
             return True
+        s2.setblocking(0)
+        self.handle_client(s2)
+        return True
 
     def handle_client(self, s):
         gobject.timeout_add(5000, self.write_socket, s, "hi !")
@@ -275,4 +278,6 @@ class TrivialStreamClient(TrivialStream):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.connect(self.socket_address)
         print "Trivial client connected to", self.socket_address
-        gobject.timeout_add(1000, self.read_socket, s)
+        s.setblocking(0)
+        gobject.io_add_watch(s, gobject.IO_IN | gobject.IO_HUP,
+            self.read_socket)
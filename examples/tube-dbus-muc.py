@@ -87,7 +87,8 @@ class Client:
             CHANNEL_INTERFACE + ".TargetHandleType": CONNECTION_HANDLE_TYPE_ROOM,
             CHANNEL_INTERFACE + ".TargetID": self.muc_id})
 
-        self.channel_text = Channel(self.conn.dbus_proxy.bus_name, chan_path)
+        self.channel_text = Channel(self.conn.dbus_proxy.bus_name, chan_path,
+            props=props)
 
         self.self_handle = self.channel_text[CHANNEL_INTERFACE_GROUP].GetSelfHandle()
         self.channel_text[CHANNEL_INTERFACE_GROUP].connect_to_signal(
@@ -103,7 +104,8 @@ class Client:
 
         for path, props in channels:
             if props[CHANNEL_INTERFACE + ".ChannelType"] == CHANNEL_TYPE_DBUS_TUBE:
-                self.tube = Channel(self.conn.dbus_proxy.bus_name, path)
+                self.tube = Channel(self.conn.dbus_proxy.bus_name, path,
+                    props=props)
 
                 self.tube[CHANNEL_INTERFACE_TUBE].connect_to_signal(
                         "TubeChannelStateChanged", self.tube_channel_state_changed_cb)
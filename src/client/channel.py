@@ -18,14 +18,33 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import dbus
+import gobject
+
+from dbus import PROPERTIES_IFACE
 
 from telepathy.client.interfacefactory import (
     InterfaceFactory, default_error_handler)
 from telepathy.interfaces import CHANNEL_INTERFACE
 
+_CHANNEL_TYPE = CHANNEL_INTERFACE + '.ChannelType'
+_INTERFACES = CHANNEL_INTERFACE + '.Interfaces'
+
 class Channel(InterfaceFactory):
     def __init__(self, service_name, object_path, bus=None, ready_handler=None,
-                 error_handler=default_error_handler):
+                 error_handler=default_error_handler, props=None):
+        """Constructor.
+
+        The channel type and interfaces are read with a single GetAll call
+        on the Channel interface, asynchronously if ready_handler is given.
+        If props, the immutable properties of the channel as given by
+        NewChannels or CreateChannel, already includes them, no call is
+        made at all and ready_handler is called from the main loop. CMs which
+        do not implement the properties are asked with GetChannelType and
+        GetInterfaces instead.
+
+        The properties of the Channel interface which are known, keyed by
+        their fully-qualified names, are kept in the properties attribute.
+        """
         if not bus:
             bus = dbus.Bus()
 
@@ -36,23 +55,71 @@ class Channel(InterfaceFactory):
         object = bus.get_object(service_name, object_path)
         InterfaceFactory.__init__(self, object, CHANNEL_INTERFACE)
 
-        if ready_handler:
-            self[CHANNEL_INTERFACE].GetChannelType(
-                reply_handler=self.get_channel_type_reply_cb,
-                error_handler=self.error_cb)
+        self.properties = {}
+        if props:
+            self.properties.update(props)
+
+        if _CHANNEL_TYPE in self.properties and \
+                _INTERFACES in self.properties:
+            self._got_properties(False)
+            if ready_handler is not None:
+                # asynchronously, as if there had been a reply, so the
+                # caller has the proxy by then
+                gobject.idle_add(self._ready_idle_cb)
+        elif ready_handler:
+            self[PROPERTIES_IFACE].GetAll(CHANNEL_INTERFACE,
+                reply_handler=self.get_all_reply_cb,
+                error_handler=self.get_all_error_cb)
         else:
-            type = self.GetChannelType()
-            interfaces = self.GetInterfaces()
-            self.get_valid_interfaces().add(type)
-            self.get_valid_interfaces().update(interfaces)
+            try:
+                self._update_properties(
+                    self[PROPERTIES_IFACE].GetAll(CHANNEL_INTERFACE))
+            except dbus.DBusException:
+                # the CM predates the Channel properties
+                pass
+            if _CHANNEL_TYPE not in self.properties:
+                self.properties[_CHANNEL_TYPE] = self.GetChannelType()
+            if _INTERFACES not in self.properties:
+                self.properties[_INTERFACES] = self.GetInterfaces()
+            self._got_properties()
+
+    def _update_properties(self, props):
+        for name, value in props.iteritems():
+            self.properties[CHANNEL_INTERFACE + '.' + name] = value
+
+    def _got_properties(self, ready=True):
+        self.get_valid_interfaces().add(self.properties[_CHANNEL_TYPE])
+        self.get_valid_interfaces().update(self.properties[_INTERFACES])
+        if ready and self._ready_handler is not None:
+            self._ready_handler(self)
+
+    def _ready_idle_cb(self):
+        self._ready_handler(self)
+        return False
+
+    def get_all_reply_cb(self, props):
+        self._update_properties(props)
+        if _CHANNEL_TYPE in self.properties and \
+                _INTERFACES in self.properties:
+            self._got_properties()
+        else:
+            self.get_all_error_cb(None)
+
+    def get_all_error_cb(self, error):
+        # the CM predates the Channel properties
+        self[CHANNEL_INTERFACE].GetChannelType(
+            reply_handler=self.get_channel_type_reply_cb,
+            error_handler=self.error_cb)
 
     def get_channel_type_reply_cb(self, interface):
+        self.properties[_CHANNEL_TYPE] = interface
         self.get_valid_interfaces().add(interface)
         self[CHANNEL_INTERFACE].GetInterfaces(
             reply_handler=self.get_interfaces_reply_cb,
             error_handler=self.error_cb)
 
     def get_interfaces_reply_cb(self, interfaces):
+        self.properties[_INTERFACES] = interfaces
         self.get_valid_interfaces().update(interfaces)
         if self._ready_handler is not None:
             self._ready_handler(self)
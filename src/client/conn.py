@@ -30,6 +30,27 @@ from telepathy.constants import CONNECTION_STATUS_CONNECTED
 class Connection(InterfaceFactory):
     def __init__(self, service_name, object_path=None, bus=None,
             ready_handler=None, error_handler=default_error_handler):
+        self._init(service_name, object_path, bus, ready_handler,
+            error_handler)
+
+        # note: old dbus-python returns None from connect_to_signal
+        self._status_changed_connection = \
+            self[CONN_INTERFACE].connect_to_signal('StatusChanged',
+                lambda status, reason: self._status_cb(status))
+        self[CONN_INTERFACE].GetStatus(
+            reply_handler=self._status_cb,
+            error_handler=error_handler)
+
+    @classmethod
+    def _new_unwatched(cls, service_name, object_path, bus, error_handler):
+        # a connection which doesn't watch its own status, as
+        # get_connections() watches the status of all the connections
+        self = cls.__new__(cls)
+        self._init(service_name, object_path, bus, None, error_handler)
+        return self
+
+    def _init(self, service_name, object_path, bus, ready_handler,
+            error_handler):
         if not bus:
             self.bus = dbus.Bus()
         else:
@@ -49,13 +70,7 @@ class Connection(InterfaceFactory):
         object = self.bus.get_object(service_name, object_path)
         InterfaceFactory.__init__(self, object, CONN_INTERFACE)
 
-        # note: old dbus-python returns None from connect_to_signal
-        self._status_changed_connection = \
-            self[CONN_INTERFACE].connect_to_signal('StatusChanged',
-                lambda status, reason: self._status_cb(status))
-        self[CONN_INTERFACE].GetStatus(
-            reply_handler=self._status_cb,
-            error_handler=error_handler)
+        self._status_changed_connection = None
 
     def _status_cb(self, status):
         if status == CONNECTION_STATUS_CONNECTED:
@@ -83,19 +98,35 @@ class Connection(InterfaceFactory):
             ready_handler(self)
 
     @staticmethod
-    def get_connections(bus=None):
-        connections = []
+    def get_connections(bus=None, ready_handler=None,
+            error_handler=default_error_handler):
+        """Return a Connection for each connection on the bus.
+
+        The connections are found with a single ListNames call. Rather
+        than adding a match rule each, they share one StatusChanged match
+        for all connections, and their statuses, then the interfaces of
+        those which are connected, are requested without waiting for each
+        other's replies.
+
+        If ready_handler is given, it is called once with the list of
+        connections when each of them is either ready or known not to be
+        connected yet; connections which disappear in the meantime are
+        left out of it and passed to error_handler.
+        """
         if not bus:
             bus = dbus.Bus()
 
         bus_object = bus.get_object('org.freedesktop.DBus', '/org/freedesktop/DBus')
 
+        discovery = _ConnectionDiscovery(bus, ready_handler, error_handler)
         for service in bus_object.ListNames(dbus_interface='org.freedesktop.DBus'):
             if service.startswith('org.freedesktop.Telepathy.Connection.'):
-                connection = Connection(service, "/%s" % service.replace(".", "/"), bus)
-                connections.append(connection)
+                connection = Connection._new_unwatched(service,
+                    "/%s" % service.replace(".", "/"), bus, error_handler)
+                discovery.add(connection)
+        discovery.start()
 
-        return connections
+        return list(discovery.connections)
 
     def request_channel(self, type, handle_type, handle, suppress_handler):
         path = self.RequestChannel(type, handle_type, handle, suppress_handler)
@@ -103,10 +134,120 @@ class Connection(InterfaceFactory):
 
     def create_channel(self, props):
         object_path, props = self[CONNECTION_INTERFACE_REQUESTS].CreateChannel(props)
-        return Channel(self.service_name, object_path, self.bus)
+        return Channel(self.service_name, object_path, self.bus,
+            props=props)
 
     def call_when_ready(self, handler):
         if self._ready:
             handler(self)
         else:
             self._ready_handlers.append(handler)
+
+
+class _ConnectionDiscovery(object):
+    """Watches the connections found by Connection.get_connections()."""
+
+    def __init__(self, bus, ready_handler, error_handler):
+        self._bus = bus
+        self._ready_handler = ready_handler
+        self._error_handler = error_handler
+        self.connections = []
+        # { object path : connection not ready yet }
+        self._waiting = {}
+        # connections whose status or interfaces have not been received
+        self._pending = set()
+        self._status_changed_match = None
+        self._name_owner_changed_match = None
+
+    def add(self, connection):
+        self.connections.append(connection)
+        self._waiting[connection.object_path] = connection
+        self._pending.add(connection)
+
+    def start(self):
+        if not self.connections:
+            self._check_done()
+            return
+
+        # a single match rule for the StatusChanged signals of all the
+        # connections, rather than one per connection; note: old
+        # dbus-python returns None from add_signal_receiver
+        self._status_changed_match = self._bus.add_signal_receiver(
+            self._status_changed_cb, 'StatusChanged', CONN_INTERFACE,
+            path_keyword='path')
+        # stop waiting for the connections which go away
+        self._name_owner_changed_match = self._bus.add_signal_receiver(
+            self._name_owner_changed_cb, 'NameOwnerChanged',
+            'org.freedesktop.DBus', 'org.freedesktop.DBus',
+            '/org/freedesktop/DBus')
+
+        for connection in self.connections:
+            connection[CONN_INTERFACE].GetStatus(
+                reply_handler=lambda status, connection=connection:
+                    self._status_cb(connection, status),
+                error_handler=lambda e, connection=connection:
+                    self._error_cb(connection, e))
+
+    def _status_changed_cb(self, status, reason, path=None):
+        connection = self._waiting.get(path)
+        if connection is not None:
+            self._status_cb(connection, status)
+
+    def _name_owner_changed_cb(self, name, old_owner, new_owner):
+        if new_owner:
+            return
+        connection = self._waiting.get('/' + name.replace('.', '/'))
+        if connection is None or connection.service_name != name:
+            return
+
+        del self._waiting[connection.object_path]
+        if connection in self._pending:
+            self.connections.remove(connection)
+            self._pending.discard(connection)
+            self._error_handler(dbus.DBusException(
+                '%s disappeared from the bus' % name,
+                name='org.freedesktop.DBus.Error.NameHasNoOwner'))
+        self._check_done()
+
+    def _status_cb(self, connection, status):
+        if connection.object_path not in self._waiting:
+            return
+
+        if status == CONNECTION_STATUS_CONNECTED:
+            connection[CONN_INTERFACE].GetInterfaces(
+                reply_handler=lambda interfaces:
+                    self._interfaces_cb(connection, interfaces),
+                error_handler=lambda e: self._error_cb(connection, e))
+        else:
+            # known not to be connected; it stays watched until it is
+            self._pending.discard(connection)
+            self._check_done()
+
+    def _interfaces_cb(self, connection, interfaces):
+        if self._waiting.pop(connection.object_path, None) is None:
+            return
+        connection._get_interfaces_reply_cb(interfaces)
+        self._pending.discard(connection)
+        self._check_done()
+
+    def _error_cb(self, connection, error):
+        if self._waiting.pop(connection.object_path, None) is None:
+            return
+        self.connections.remove(connection)
+        self._pending.discard(connection)
+        self._error_handler(error)
+        self._check_done()
+
+    def _check_done(self):
+        if not self._waiting:
+            if self._status_changed_match is not None:
+                self._status_changed_match.remove()
+                self._status_changed_match = None
+            if self._name_owner_changed_match is not None:
+                self._name_owner_changed_match.remove()
+                self._name_owner_changed_match = None
+
+        if not self._pending and self._ready_handler is not None:
+            ready_handler = self._ready_handler
+            self._ready_handler = None
+            ready_handler(list(self.connections))
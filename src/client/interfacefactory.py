@@ -22,12 +22,108 @@ import logging
 
 from dbus import PROPERTIES_IFACE
 
+from telepathy.interfaces import (CHANNEL_INTERFACE_GROUP,
+                                  CHANNEL_INTERFACE_MESSAGES,
+                                  CHANNEL_INTERFACE_TUBE,
+                                  CHANNEL_TYPE_CONTACT_SEARCH,
+                                  CHANNEL_TYPE_DBUS_TUBE,
+                                  CHANNEL_TYPE_FILE_TRANSFER,
+                                  CHANNEL_INTERFACE,
+                                  CONN_INTERFACE,
+                                  CONNECTION_INTERFACE_REQUESTS)
+
 logger = logging.getLogger('telepathy.client.interfacefactory')
 
 def default_error_handler(exception):
     logging.basicConfig()
     logger.warning('Exception from asynchronous method call:\n%s' % exception)
 
+# { interface : { signal : properties it changes, or None for all the
+# properties of the object } }, for the interfaces which signal changes to
+# their properties without PropertiesChanged. Only the properties of these
+# interfaces are cached: the others may change without any signal.
+_PROPERTY_CHANGE_SIGNALS = {
+    # all the properties of the Channel interface are immutable
+    CHANNEL_INTERFACE: {},
+    CONN_INTERFACE: {
+        'SelfHandleChanged': ['SelfHandle'],
+        'StatusChanged': None,
+        },
+    CONNECTION_INTERFACE_REQUESTS: {
+        'NewChannels': ['Channels'],
+        'ChannelClosed': ['Channels'],
+        },
+    CHANNEL_INTERFACE_GROUP: {
+        'GroupFlagsChanged': ['GroupFlags'],
+        'HandleOwnersChanged': ['HandleOwners'],
+        'MembersChanged': ['Members', 'LocalPendingMembers',
+                           'RemotePendingMembers'],
+        'SelfHandleChanged': ['SelfHandle'],
+        },
+    CHANNEL_INTERFACE_MESSAGES: {
+        'MessageReceived': ['PendingMessages'],
+        'PendingMessagesRemoved': ['PendingMessages'],
+        },
+    CHANNEL_INTERFACE_TUBE: {
+        'TubeChannelStateChanged': ['State'],
+        },
+    CHANNEL_TYPE_CONTACT_SEARCH: {
+        'SearchStateChanged': ['SearchState'],
+        },
+    CHANNEL_TYPE_DBUS_TUBE: {
+        'DBusNamesChanged': ['DBusNames'],
+        },
+    CHANNEL_TYPE_FILE_TRANSFER: {
+        'FileTransferStateChanged': ['State'],
+        'InitialOffsetDefined': ['InitialOffset'],
+        'TransferredBytesChanged': ['TransferredBytes'],
+        },
+    }
+
+class _CachedProperties(object):
+    """Stands in for the D-Bus properties interface of an InterfaceFactory
+    whose property cache is enabled."""
+
+    def __init__(self, factory, interface):
+        self._factory = factory
+        self._interface = interface
+
+    def Get(self, interface_name, property_name, **kwargs):
+        if 'reply_handler' in kwargs:
+            return self._interface.Get(interface_name, property_name,
+                **self._factory._caching_handlers(kwargs,
+                    lambda value: self._factory._cache_property(
+                        interface_name, property_name, value)))
+        if kwargs:
+            # options such as timeout are for the call to the object
+            value = self._interface.Get(interface_name, property_name,
+                **kwargs)
+            self._factory._cache_property(interface_name, property_name,
+                value)
+            return value
+        return self._factory.get_property(interface_name, property_name)
+
+    def GetAll(self, interface_name, **kwargs):
+        if 'reply_handler' in kwargs:
+            return self._interface.GetAll(interface_name,
+                **self._factory._caching_handlers(kwargs,
+                    lambda props: self._factory._cache_properties(
+                        interface_name, props)))
+        if kwargs:
+            props = self._interface.GetAll(interface_name, **kwargs)
+            self._factory._cache_properties(interface_name, props)
+            return props
+        return self._factory.get_all_properties(interface_name)
+
+    def Set(self, interface_name, property_name, value, **kwargs):
+        # the connection manager may not store the value as given
+        self._factory._invalidate_properties(interface_name, [property_name])
+        return self._interface.Set(interface_name, property_name, value,
+            **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._interface, name)
+
 class InterfaceFactory(object):
     """Base class for an object wrapping the D-Bus interfaces of a Telepathy
     object.
@@ -65,10 +161,26 @@ class InterfaceFactory(object):
         if default_interface:
             self._valid_interfaces.add(default_interface)
 
+        # { interface : { property : value } }, or None if the property
+        # cache is disabled
+        self._property_cache = None
+        # interfaces whose properties are all in the cache
+        self._property_cache_complete = set()
+        # interfaces whose change signals are connected
+        self._property_cache_watched = set()
+        self._property_cache_matches = []
+
+        #: The number of property reads answered from the cache, and of
+        #: those which had to ask the object.
+        self.property_cache_hits = 0
+        self.property_cache_misses = 0
+
     def get_valid_interfaces(self):
         return self._valid_interfaces
 
     def __getitem__(self, name):
+        if name == PROPERTIES_IFACE and self._property_cache is not None:
+            return self._cached_properties
         if name not in self._interfaces:
             if name not in self._valid_interfaces:
                 raise KeyError(name)
@@ -82,3 +194,205 @@ class InterfaceFactory(object):
 
     def __getattr__(self, name):
         return getattr(self[self._default_interface], name)
+
+    def enable_property_cache(self, interfaces=None, reply_handler=None,
+                              error_handler=default_error_handler):
+        """Keep the D-Bus properties of the object in a local cache.
+
+        Once enabled, the Get and GetAll methods of
+        ``self[PROPERTIES_IFACE]``, as well as `get_property` and
+        `get_all_properties`, are answered from the cache when they are
+        called synchronously without options such as timeout.
+        Asynchronous calls still go to the object but their replies are
+        cached. Cached properties are forgotten when the object emits
+        PropertiesChanged, or one of the Telepathy signals which announce
+        a change to them, such as MembersChanged. Only the properties of
+        the interfaces which have such signals, and of the Channel
+        interface, are cached; reading the others always asks the object.
+
+        :Parameters:
+            `interfaces` : list of str
+                The interfaces whose properties are fetched straight away,
+                with one GetAll call each; by default, all the interfaces
+                known to be valid. Interfaces whose properties are not
+                cached are skipped.
+            `reply_handler` : callable
+                If given, the properties are fetched asynchronously and
+                this is called with this object once they all are
+            `error_handler` : callable
+                Called with the error if fetching the properties of an
+                interface fails asynchronously
+        """
+        if self._property_cache is None:
+            self._property_cache = {}
+            properties = self._get_properties_interface()
+            self._cached_properties = _CachedProperties(self, properties)
+            self._connect_property_signal(properties, 'PropertiesChanged',
+                self._properties_changed_cb)
+
+        if interfaces is None:
+            interfaces = self._valid_interfaces
+        # connect the change signals before fetching the properties, so
+        # that no change is missed
+        interfaces = [interface for interface in interfaces
+                      if self._watch_properties(interface)]
+
+        if reply_handler is None:
+            for interface in interfaces:
+                try:
+                    self._cache_properties(interface,
+                        self._get_properties_interface().GetAll(interface))
+                except dbus.DBusException, e:
+                    # probably an interface without properties, or a
+                    # connection manager predating them
+                    logger.debug('not caching the properties of %s: %s'
+                        % (interface, e))
+            return
+
+        pending = set(interfaces)
+
+        def done(interface):
+            pending.discard(interface)
+            if not pending:
+                reply_handler(self)
+
+        def reply_cb(props, interface):
+            self._cache_properties(interface, props)
+            done(interface)
+
+        def error_cb(e, interface):
+            error_handler(e)
+            done(interface)
+
+        if not pending:
+            reply_handler(self)
+        for interface in interfaces:
+            self._get_properties_interface().GetAll(interface,
+                reply_handler=lambda props, interface=interface:
+                    reply_cb(props, interface),
+                error_handler=lambda e, interface=interface:
+                    error_cb(e, interface))
+
+    def disable_property_cache(self):
+        """Stop caching properties and forget those which are cached."""
+        if self._property_cache is None:
+            return
+
+        for match in self._property_cache_matches:
+            match.remove()
+        self._property_cache_matches = []
+        self._property_cache = None
+        self._property_cache_complete.clear()
+        self._property_cache_watched.clear()
+        del self._cached_properties
+
+    def get_property(self, interface, name):
+        """Return the value of a property of the object, from the cache if
+        it is enabled and holds it."""
+        cache = self._property_cache
+        if cache is not None:
+            props = cache.get(interface)
+            if props is not None and name in props:
+                self.property_cache_hits += 1
+                return props[name]
+            self.property_cache_misses += 1
+
+        value = self._get_properties_interface().Get(interface, name)
+        self._cache_property(interface, name, value)
+        return value
+
+    def get_all_properties(self, interface):
+        """Return a dict of the properties of the object on an interface,
+        from the cache if it is enabled and holds them all."""
+        cache = self._property_cache
+        if cache is not None:
+            if interface in self._property_cache_complete:
+                self.property_cache_hits += 1
+                return dict(cache[interface])
+            self.property_cache_misses += 1
+
+        props = self._get_properties_interface().GetAll(interface)
+        self._cache_properties(interface, props)
+        return dict(props)
+
+    def _get_properties_interface(self):
+        # self[PROPERTIES_IFACE] is the cache while it is enabled
+        if PROPERTIES_IFACE not in self._interfaces:
+            self._interfaces[PROPERTIES_IFACE] = dbus.Interface(
+                self._dbus_object, PROPERTIES_IFACE)
+        return self._interfaces[PROPERTIES_IFACE]
+
+    def _watch_properties(self, interface):
+        # connect the signals announcing changes to the properties of the
+        # interface, if it has any, and return whether they can be cached
+        if interface in self._property_cache_watched:
+            return True
+        signals = _PROPERTY_CHANGE_SIGNALS.get(interface)
+        if signals is None:
+            return False
+
+        # the interface may not be valid yet, for instance Group on a
+        # channel which is not ready
+        proxy = dbus.Interface(self._dbus_object, interface)
+        for signal, names in signals.iteritems():
+            self._connect_property_signal(proxy, signal,
+                self._make_invalidate_cb(interface, names))
+        self._property_cache_watched.add(interface)
+        return True
+
+    def _connect_property_signal(self, interface, signal, handler):
+        match = interface.connect_to_signal(signal, handler)
+        # note: old dbus-python returns None from connect_to_signal
+        if match is not None:
+            self._property_cache_matches.append(match)
+
+    def _make_invalidate_cb(self, interface, names):
+        def invalidate_cb(*args):
+            self._invalidate_properties(interface, names)
+        return invalidate_cb
+
+    def _caching_handlers(self, kwargs, cache_cb):
+        kwargs = dict(kwargs)
+        reply_handler = kwargs['reply_handler']
+
+        def reply_cb(*args):
+            if self._property_cache is not None:
+                cache_cb(*args)
+            reply_handler(*args)
+
+        kwargs['reply_handler'] = reply_cb
+        return kwargs
+
+    def _cache_property(self, interface, name, value):
+        if (self._property_cache is not None
+                and self._watch_properties(interface)):
+            self._property_cache.setdefault(interface, {})[name] = value
+
+    def _cache_properties(self, interface, props):
+        if (self._property_cache is not None
+                and self._watch_properties(interface)):
+            self._property_cache[interface] = dict(props)
+            self._property_cache_complete.add(interface)
+
+    def _invalidate_properties(self, interface, names):
+        if self._property_cache is None:
+            return
+
+        if names is None:
+            self._property_cache.clear()
+            self._property_cache_complete.clear()
+            return
+
+        props = self._property_cache.get(interface)
+        if props is not None and names:
+            for name in names:
+                props.pop(name, None)
+            self._property_cache_complete.discard(interface)
+
+    def _properties_changed_cb(self, interface, changed, invalidated):
+        if self._property_cache is None:
+            return
+
+        self._invalidate_properties(interface, invalidated)
+        if changed and interface in self._property_cache_watched:
+            self._property_cache.setdefault(interface, {}).update(changed)
@@ -20,6 +20,7 @@ License along with this library; if not, write to the Free Software
 Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 """
 
+from telepathy.server.avatars import *
 from telepathy.server.connmgr import *
 from telepathy.server.conn import *
 from telepathy.server.channel import *
@@ -27,7 +28,9 @@ from telepathy.server.channelmanager import *
 from telepathy.server.debug import *
 from telepathy.server.handle import *
 from telepathy.server.media import *
+from telepathy.server.pendingmessages import *
 from telepathy.server.properties import *
+from telepathy.server.transfer import *
 
 from telepathy._generated.Client_Observer import ClientObserver as Observer
 from telepathy._generated.Client_Approver import ClientApprover as Approver
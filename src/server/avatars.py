@@ -0,0 +1,203 @@
+# telepathy-python - Base classes defining the interfaces of the Telepathy framework
+#
+# Copyright (C) 2010 Collabora Limited
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import mmap
+import os
+import tempfile
+import threading
+
+try:
+    from hashlib import sha1
+except ImportError:
+    # Python 2.4
+    from sha import new as sha1
+
+# 16 MiB
+DEFAULT_AVATAR_CACHE_SIZE = 16 * 1024 * 1024
+
+class AvatarCache(object):
+    """
+    A store of avatar images on disk, indexed by avatar token.
+
+    Each avatar is kept in its own file in directory, named after the SHA-1
+    hash of its token, which holds the MIME type on the first line followed
+    by the image data. Files are written atomically and read back through
+    mmap. When the avatars take more than max_size bytes, the least recently
+    used ones are deleted.
+
+    The avatars already in directory are picked up when the cache is
+    created, their modification times giving the order in which they were
+    last used. All the methods may be called from any thread.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_AVATAR_CACHE_SIZE):
+        self._directory = directory
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        # { file name : [size, last use] }
+        self._entries = {}
+        self._size = 0
+        self._clock = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+
+        found = []
+        for name in os.listdir(directory):
+            if len(name) != 40:
+                # temporary files and anything else which is not ours
+                continue
+            try:
+                st = os.stat(os.path.join(directory, name))
+            except OSError:
+                continue
+            found.append((st.st_mtime, name, st.st_size))
+        found.sort()
+        for mtime, name, size in found:
+            self._clock += 1
+            self._entries[name] = [size, self._clock]
+            self._size += size
+
+        self._lock.acquire()
+        try:
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def _name(self, token):
+        if isinstance(token, unicode):
+            token = token.encode('utf-8')
+        return sha1(token).hexdigest()
+
+    def __contains__(self, token):
+        return self._name(token) in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_size(self):
+        """Return the number of bytes used by the cached avatars."""
+        return self._size
+
+    def get(self, token):
+        """
+        Return the avatar with the given token as a (data, MIME type) tuple,
+        or None if it is not in the cache.
+        """
+        name = self._name(token)
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            self._clock += 1
+            entry[1] = self._clock
+        finally:
+            self._lock.release()
+
+        path = os.path.join(self._directory, name)
+        try:
+            f = open(path, 'rb')
+            try:
+                # mmap raises ValueError for an empty file
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    end = m.find('\n')
+                    if end < 0:
+                        raise ValueError('no MIME type in %s' % path)
+                    mime_type = m[:end]
+                    data = m[end + 1:]
+                finally:
+                    m.close()
+            finally:
+                f.close()
+            # keep the order of use across restarts
+            os.utime(path, None)
+        except (IOError, OSError, mmap.error, ValueError):
+            # evicted by another thread, removed behind our back, or
+            # truncated
+            self._forget(name)
+            return None
+
+        return data, mime_type
+
+    def set(self, token, data, mime_type):
+        """Store the avatar with the given token, replacing any old one."""
+        name = self._name(token)
+        fd, temp = tempfile.mkstemp(prefix='.avatar-', dir=self._directory)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(mime_type)
+                f.write('\n')
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(temp, os.path.join(self._directory, name))
+        except:
+            os.unlink(temp)
+            raise
+
+        size = len(mime_type) + 1 + len(data)
+        self._lock.acquire()
+        try:
+            old = self._entries.get(name)
+            if old is not None:
+                self._size -= old[0]
+            self._clock += 1
+            self._entries[name] = [size, self._clock]
+            self._size += size
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def remove(self, token):
+        """Remove the avatar with the given token, if it is cached."""
+        name = self._name(token)
+        if self._forget(name):
+            try:
+                os.unlink(os.path.join(self._directory, name))
+            except OSError:
+                pass
+
+    def _forget(self, name):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(name, None)
+            if entry is None:
+                return False
+            self._size -= entry[0]
+            return True
+        finally:
+            self._lock.release()
+
+    def _evict(self):
+        # called with the lock held
+        if self._size <= self._max_size:
+            return
+
+        lru = [(use, name) for name, (size, use) in self._entries.iteritems()]
+        lru.sort()
+        for use, name in lru:
+            if self._size <= self._max_size:
+                break
+            self._size -= self._entries.pop(name)[0]
+            try:
+                os.unlink(os.path.join(self._directory, name))
+            except OSError:
+                pass
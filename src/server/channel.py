@@ -19,20 +19,47 @@
 
 import dbus
 import dbus.service
+import errno
+import gobject
+import logging
+import os
+import socket
 
 from telepathy.constants import (CONNECTION_HANDLE_TYPE_NONE,
-                                 CHANNEL_TEXT_MESSAGE_TYPE_NORMAL)
-
-from telepathy.errors import InvalidArgument
+                                 CHANNEL_TEXT_MESSAGE_TYPE_NORMAL,
+                                 FILE_HASH_TYPE_NONE,
+                                 FILE_TRANSFER_STATE_ACCEPTED,
+                                 FILE_TRANSFER_STATE_CANCELLED,
+                                 FILE_TRANSFER_STATE_CHANGE_REASON_LOCAL_ERROR,
+                                 FILE_TRANSFER_STATE_CHANGE_REASON_LOCAL_STOPPED,
+                                 FILE_TRANSFER_STATE_CHANGE_REASON_NONE,
+                                 FILE_TRANSFER_STATE_CHANGE_REASON_REMOTE_ERROR,
+                                 FILE_TRANSFER_STATE_COMPLETED,
+                                 FILE_TRANSFER_STATE_OPEN,
+                                 FILE_TRANSFER_STATE_PENDING,
+                                 SOCKET_ACCESS_CONTROL_CREDENTIALS,
+                                 SOCKET_ACCESS_CONTROL_LOCALHOST,
+                                 SOCKET_ADDRESS_TYPE_IPV4,
+                                 SOCKET_ADDRESS_TYPE_IPV6,
+                                 SOCKET_ADDRESS_TYPE_UNIX,
+                                 TUBE_CHANNEL_STATE_LOCAL_PENDING,
+                                 TUBE_CHANNEL_STATE_NOT_OFFERED,
+                                 TUBE_CHANNEL_STATE_REMOTE_PENDING)
+
+from telepathy.errors import (Cancelled, InvalidArgument, NotAvailable,
+                              NotImplemented)
 
 from telepathy.interfaces import (CHANNEL_INTERFACE,
                                   CHANNEL_INTERFACE_DTMF,
                                   CHANNEL_INTERFACE_GROUP,
                                   CHANNEL_INTERFACE_HOLD,
                                   CHANNEL_INTERFACE_PASSWORD,
+                                  CHANNEL_INTERFACE_TUBE,
                                   CHANNEL_TYPE_CONTACT_LIST,
+                                  CHANNEL_TYPE_DBUS_TUBE,
                                   CHANNEL_TYPE_FILE_TRANSFER,
                                   CHANNEL_TYPE_ROOM_LIST,
+                                  CHANNEL_TYPE_STREAM_TUBE,
                                   CHANNEL_TYPE_STREAMED_MEDIA,
                                   CHANNEL_TYPE_TEXT,
                                   MEDIA_SESSION_HANDLER,
@@ -41,6 +68,11 @@ from telepathy.interfaces import (CHANNEL_INTERFACE,
 from telepathy._generated.Channel import Channel as _Channel
 
 from telepathy.server.properties import DBusProperties
+from telepathy.server.pendingmessages import PendingMessageQueue
+from telepathy.server.transfer import (DBusTubeMultiplexer, SocketListener,
+                                       StreamHasher, StreamPump, StreamRelay)
+
+logger = logging.getLogger('telepathy.server.channel')
 
 class Channel(_Channel, DBusProperties):
 
@@ -61,6 +93,7 @@ class Channel(_Channel, DBusProperties):
         self._requested = props[CHANNEL_INTERFACE + '.Requested']
 
         self._immutable_properties = dict()
+        self._immutable_props_snapshot = None
 
         self._handle = self._conn.handle(
             props[CHANNEL_INTERFACE + '.TargetHandleType'],
@@ -75,6 +108,8 @@ class Channel(_Channel, DBusProperties):
              'TargetHandleType': lambda: dbus.UInt32(self._get_handle_type()),
              'TargetID': lambda: dbus.String(self._get_target_id()),
              'Requested': lambda: self._requested})
+        # these are all immutable
+        self._cache_property_get(CHANNEL_INTERFACE)
 
         self._add_immutables({
             'ChannelType': CHANNEL_INTERFACE,
@@ -87,6 +122,8 @@ class Channel(_Channel, DBusProperties):
 
     def _add_immutables(self, props):
         self._immutable_properties.update(props)
+        # rebuilt on the next get_props() call
+        self._immutable_props_snapshot = None
 
     def _get_handle_type(self):
         if self._handle:
@@ -101,11 +138,20 @@ class Channel(_Channel, DBusProperties):
             return ''
 
     def get_props(self):
-        props = dict()
-        for prop, iface in self._immutable_properties.items():
-            props[iface + '.' + prop] = \
-                self._prop_getters[iface][prop]()
-        return props
+        """
+        Return the immutable properties of the channel as a dbus.Dictionary.
+
+        As these properties never change, they are only evaluated the first
+        time this is called. The returned dictionary is shared between
+        callers and must not be modified.
+        """
+        if self._immutable_props_snapshot is None:
+            props = dbus.Dictionary(signature='sv')
+            for prop, iface in self._immutable_properties.items():
+                props[iface + '.' + prop] = \
+                    self._prop_getters[iface][prop]()
+            self._immutable_props_snapshot = props
+        return self._immutable_props_snapshot
 
     @dbus.service.method(CHANNEL_INTERFACE, in_signature='', out_signature='')
     def Close(self):
@@ -160,21 +206,677 @@ from telepathy._generated.Channel_Type_File_Transfer \
 class ChannelTypeFileTransfer(Channel, _ChannelTypeFileTransferIface):
     __doc__ = _ChannelTypeFileTransferIface.__doc__
 
+    # the most often TransferredBytesChanged may be emitted, in milliseconds
+    _transferred_bytes_interval = 1000
+    # set to a TransferStateStore to remember how far interrupted transfers
+    # got; see get_resume_offset()
+    _transfer_state_store = None
+
     def __init__(self, connection, manager, props):
         """
         Initialise the channel.
 
         Parameters:
         connection - the parent Telepathy Connection object
+
+        Subclasses implement _accept_file() for incoming transfers, and
+        call open_transfer() with the protocol side of the transfer once
+        the data can flow; the base class then moves the data between it
+        and the socket given to the client by AcceptFile or ProvideFile.
+
+        If ContentHashType is set, the data is hashed as it goes through
+        and the transfer only completes if the result matches ContentHash.
         """
         Channel.__init__(self, connection, manager, props)
 
+        iface = CHANNEL_TYPE_FILE_TRANSFER
+        self._state = FILE_TRANSFER_STATE_PENDING
+        self._content_type = props.get(iface + '.ContentType', '')
+        self._filename = props.get(iface + '.Filename', '')
+        self._size = props.get(iface + '.Size', 0)
+        self._content_hash_type = props.get(iface + '.ContentHashType',
+            FILE_HASH_TYPE_NONE)
+        self._content_hash = props.get(iface + '.ContentHash', '')
+        self._description = props.get(iface + '.Description', '')
+        self._date = props.get(iface + '.Date', 0)
+        self._initial_offset = props.get(iface + '.InitialOffset', 0)
+        self._initial_offset_defined = False
+        # { socket address type : [socket access control] }
+        self._socket_types = {
+            SOCKET_ADDRESS_TYPE_UNIX: [SOCKET_ACCESS_CONTROL_LOCALHOST],
+            SOCKET_ADDRESS_TYPE_IPV4: [SOCKET_ACCESS_CONTROL_LOCALHOST],
+            SOCKET_ADDRESS_TYPE_IPV6: [SOCKET_ACCESS_CONTROL_LOCALHOST],
+            }
+
+        self._transferred_bytes = 0
+        self._signalled_bytes = 0
+        self._transferred_bytes_id = None
+        self._hasher = None
+        self._computed_hash = None
+
+        # the socket the client connects to, the client's connection to
+        # it, and the protocol side of the transfer
+        self._listener = None
+        self._client = None
+        self._peer = None
+        self._pump = None
+
+        self._implement_property_get(iface, {
+            'State': lambda: dbus.UInt32(self._state),
+            'ContentType': lambda: dbus.String(self._content_type),
+            'Filename': lambda: dbus.String(self._filename),
+            'Size': lambda: dbus.UInt64(self._size),
+            'ContentHashType': lambda: dbus.UInt32(self._content_hash_type),
+            'ContentHash': lambda: dbus.String(self._content_hash),
+            'Description': lambda: dbus.String(self._description),
+            'Date': lambda: dbus.Int64(self._date),
+            'AvailableSocketTypes': lambda: dbus.Dictionary(
+                self._socket_types, signature='uau'),
+            'TransferredBytes': lambda: dbus.UInt64(self._transferred_bytes),
+            'InitialOffset': lambda: dbus.UInt64(self._initial_offset),
+            })
 
-from telepathy._generated.Channel_Type_File_Transfer \
-        import ChannelTypeFileTransfer as _ChannelTypeFileTransferIface
+        self._add_immutables({
+            'ContentType': iface,
+            'Filename': iface,
+            'Size': iface,
+            'ContentHashType': iface,
+            'ContentHash': iface,
+            'Description': iface,
+            'Date': iface,
+            'AvailableSocketTypes': iface,
+            })
 
-class ChannelTypeFileTransfer(Channel, _ChannelTypeFileTransferIface):
-    __doc__ = _ChannelTypeFileTransferIface.__doc__
+    def _check_socket_type(self, address_type, access_control):
+        if access_control not in self._socket_types.get(address_type, ()):
+            raise NotImplemented('socket type %d with access control %d '
+                'is not supported' % (address_type, access_control))
+
+    def _listen(self, address_type, access_control, access_control_param):
+        self._check_socket_type(address_type, access_control)
+        self._listener = SocketListener(address_type, access_control,
+            access_control_param)
+        self._listener.accept(self._client_connected_cb)
+        return self._listener.address
+
+    @dbus.service.method(CHANNEL_TYPE_FILE_TRANSFER, in_signature='uuvt',
+                         out_signature='v')
+    def AcceptFile(self, address_type, access_control, access_control_param,
+                   offset):
+        if self._requested or self._state != FILE_TRANSFER_STATE_PENDING:
+            raise NotAvailable('the file transfer is not pending')
+        if offset > self._size:
+            raise InvalidArgument('offset %d is beyond the end of the file'
+                % offset)
+
+        address = self._listen(address_type, access_control,
+            access_control_param)
+        self._initial_offset = offset
+        try:
+            self._accept_file(offset)
+        except:
+            self._close_sockets()
+            raise
+
+        self.set_state(FILE_TRANSFER_STATE_ACCEPTED)
+        return address
+
+    def _accept_file(self, offset):
+        """
+        Accept the incoming transfer on the protocol side, asking to start
+        at the given offset. Subclasses call set_initial_offset() if a
+        different offset is used, and open_transfer() once the data can be
+        received.
+        """
+        raise NotImplemented('incoming file transfers are not supported')
+
+    @dbus.service.method(CHANNEL_TYPE_FILE_TRANSFER, in_signature='uuv',
+                         out_signature='v')
+    def ProvideFile(self, address_type, access_control, access_control_param):
+        if not self._requested:
+            raise NotAvailable('the file transfer is not outgoing')
+        if self._listener is not None:
+            raise NotAvailable('ProvideFile has already been called')
+        if self._state in (FILE_TRANSFER_STATE_COMPLETED,
+                           FILE_TRANSFER_STATE_CANCELLED):
+            raise NotAvailable('the file transfer is over')
+
+        address = self._listen(address_type, access_control,
+            access_control_param)
+
+        if self._peer is not None:
+            # the transfer was already accepted
+            self.set_state(FILE_TRANSFER_STATE_OPEN)
+        return address
+
+    def set_state(self, state, reason=FILE_TRANSFER_STATE_CHANGE_REASON_NONE):
+        """
+        Change the state of the transfer and emit FileTransferStateChanged.
+        Once the transfer is completed or cancelled, the sockets for the
+        client are closed.
+        """
+        if state == self._state:
+            return
+
+        if state == FILE_TRANSFER_STATE_OPEN and \
+                not self._initial_offset_defined:
+            self.set_initial_offset(self._initial_offset)
+
+        if state in (FILE_TRANSFER_STATE_COMPLETED,
+                     FILE_TRANSFER_STATE_CANCELLED):
+            if self._pump is not None:
+                self._pump.stop()
+                self._pump = None
+            if self._hasher is not None:
+                self._hasher.cancel()
+                self._hasher = None
+            self._close_sockets()
+            self.flush_transferred_bytes()
+
+        self._state = state
+        self.FileTransferStateChanged(state, reason)
+
+        if state in (FILE_TRANSFER_STATE_COMPLETED,
+                     FILE_TRANSFER_STATE_CANCELLED):
+            self._save_transfer_state()
+
+        if state == FILE_TRANSFER_STATE_OPEN:
+            self._start_pump()
+
+    def set_initial_offset(self, offset):
+        """
+        Set the offset the transfer really starts at, and emit
+        InitialOffsetDefined. This is done when the transfer is opened if it
+        has not been already.
+        """
+        self._initial_offset = offset
+        self._initial_offset_defined = True
+        self.InitialOffsetDefined(offset)
+
+    def open_transfer(self, peer):
+        """
+        Start the transfer once it has been accepted on both sides.
+
+        peer is the protocol side of the transfer, a non-blocking socket or
+        a file object which the data is read from for incoming transfers
+        and written to for outgoing ones. Files are first seeked to
+        InitialOffset. The transfer becomes Open now if the client has
+        already accepted it, or as soon as ProvideFile is called.
+        """
+        self._peer = peer
+        if not isinstance(peer, socket.socket) and hasattr(peer, 'seek'):
+            peer.seek(self._initial_offset)
+
+        if not self._requested or self._listener is not None:
+            self.set_state(FILE_TRANSFER_STATE_OPEN)
+
+    def _client_connected_cb(self, conn):
+        if self._client is not None:
+            # only one client may connect
+            conn.close()
+            return
+
+        self._client = conn
+        self._start_pump()
+
+    def _start_pump(self):
+        if self._pump is not None or self._client is None or \
+                self._peer is None or self._state != FILE_TRANSFER_STATE_OPEN:
+            return
+
+        if self._requested:
+            source, sink = self._client, self._peer
+        else:
+            source, sink = self._peer, self._client
+
+        data_cb = None
+        if self._content_hash_type != FILE_HASH_TYPE_NONE:
+            self._hasher = self._create_hasher()
+            if self._hasher is not None:
+                data_cb = self._hasher.update
+
+        self._pump = StreamPump(source, sink,
+            self._size - self._initial_offset,
+            self._transferred_cb, self._pump_done_cb, data_cb=data_cb)
+        self._pump.start()
+
+    def _create_hasher(self):
+        # the bytes before InitialOffset can only be hashed if the protocol
+        # side is a file which has them
+        prefix_path = None
+        if self._initial_offset:
+            prefix_path = getattr(self._peer, 'name', None)
+            if not isinstance(prefix_path, basestring) or \
+                    not os.path.isfile(prefix_path):
+                return None
+
+        try:
+            return StreamHasher(self._content_hash_type, self._hash_done_cb,
+                prefix_path, self._initial_offset)
+        except NotImplemented:
+            return None
+
+    def get_computed_hash(self):
+        """
+        Return the hash of the file computed during the transfer, of type
+        ContentHashType, or None if it is not known (yet).
+        """
+        return self._computed_hash
+
+    def _transferred_cb(self, count):
+        self._transferred_bytes = self._initial_offset + count
+        if self._transferred_bytes_id is None:
+            self._transferred_bytes_id = gobject.timeout_add(
+                self._transferred_bytes_interval,
+                self._transferred_bytes_cb)
+
+    def _transferred_bytes_cb(self):
+        if self._transferred_bytes == self._signalled_bytes:
+            # nothing moved since the last signal
+            self._transferred_bytes_id = None
+            return False
+
+        self._signalled_bytes = self._transferred_bytes
+        self.TransferredBytesChanged(self._transferred_bytes)
+        self._save_transfer_state()
+        return True
+
+    def flush_transferred_bytes(self):
+        """
+        Emit TransferredBytesChanged now if the count changed since it was
+        last signalled.
+        """
+        if self._transferred_bytes_id is not None:
+            gobject.source_remove(self._transferred_bytes_id)
+            self._transferred_bytes_id = None
+
+        if self._transferred_bytes != self._signalled_bytes:
+            self._signalled_bytes = self._transferred_bytes
+            self.TransferredBytesChanged(self._transferred_bytes)
+
+    def _pump_done_cb(self, source_error, sink_error):
+        self._pump = None
+        if source_error is None and sink_error is None:
+            if self._hasher is not None:
+                # complete once the worker has caught up
+                self._hasher.finish()
+            else:
+                self.set_state(FILE_TRANSFER_STATE_COMPLETED)
+            return
+
+        if self._requested:
+            client_failed = source_error is not None
+        else:
+            client_failed = sink_error is not None
+        if client_failed:
+            reason = FILE_TRANSFER_STATE_CHANGE_REASON_LOCAL_ERROR
+        else:
+            reason = FILE_TRANSFER_STATE_CHANGE_REASON_REMOTE_ERROR
+        self.set_state(FILE_TRANSFER_STATE_CANCELLED, reason)
+
+    def _hash_done_cb(self, digest):
+        self._hasher = None
+        self._computed_hash = digest
+        if digest is None or not self._content_hash or \
+                digest == self._content_hash.lower():
+            self.set_state(FILE_TRANSFER_STATE_COMPLETED)
+            return
+
+        if self._requested:
+            reason = FILE_TRANSFER_STATE_CHANGE_REASON_LOCAL_ERROR
+        else:
+            reason = FILE_TRANSFER_STATE_CHANGE_REASON_REMOTE_ERROR
+        self.set_state(FILE_TRANSFER_STATE_CANCELLED, reason)
+
+        # the data which went through is not the file that was offered, so
+        # a retry must start from scratch
+        if self._transfer_state_store is not None:
+            self._transfer_state_store.forget(self._get_transfer_key())
+
+    def _get_transfer_key(self):
+        """
+        Return what identifies this transfer in the _transfer_state_store,
+        so that offering the same file to or from the same contact again is
+        recognised as a retry.
+        """
+        return (self._requested, self._get_target_id(), self._filename,
+                self._size, self._date, self._content_hash_type,
+                self._content_hash)
+
+    def get_resume_offset(self):
+        """
+        Return the offset an earlier attempt at this transfer got to, if
+        _transfer_state_store is set and remembers one, or 0. Subclasses
+        propose it as the initial offset to the other side, and call
+        set_initial_offset() with what is agreed.
+        """
+        if self._transfer_state_store is None:
+            return 0
+        return min(self._transfer_state_store.get_offset(
+            self._get_transfer_key()), self._size)
+
+    def _save_transfer_state(self):
+        store = self._transfer_state_store
+        if store is None:
+            return
+        if self._state == FILE_TRANSFER_STATE_COMPLETED:
+            store.forget(self._get_transfer_key())
+        elif self._transferred_bytes > self._initial_offset:
+            store.set_offset(self._get_transfer_key(),
+                self._transferred_bytes)
+
+    def _close_sockets(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+
+    @dbus.service.method(CHANNEL_INTERFACE, in_signature='', out_signature='')
+    def Close(self):
+        if self._state not in (FILE_TRANSFER_STATE_COMPLETED,
+                               FILE_TRANSFER_STATE_CANCELLED):
+            self.set_state(FILE_TRANSFER_STATE_CANCELLED,
+                FILE_TRANSFER_STATE_CHANGE_REASON_LOCAL_STOPPED)
+        Channel.Close(self)
+
+
+from telepathy._generated.Channel_Type_Stream_Tube \
+        import ChannelTypeStreamTube as _ChannelTypeStreamTubeIface
+from telepathy._generated.Channel_Interface_Tube \
+        import ChannelInterfaceTube as _ChannelInterfaceTube
+
+# not in the errors of this version of the spec, but used by
+# ConnectionClosed
+_CONNECTION_LOST = 'org.freedesktop.Telepathy.Error.ConnectionLost'
+
+class ChannelTypeStreamTube(Channel, _ChannelTypeStreamTubeIface,
+                            _ChannelInterfaceTube):
+    __doc__ = _ChannelTypeStreamTubeIface.__doc__
+
+    def __init__(self, connection, manager, props):
+        """
+        Initialise the channel.
+
+        Parameters:
+        connection - the parent Telepathy Connection object
+
+        Each connection through the tube is relayed between a local socket
+        and a non-blocking socket for the protocol transport by a
+        StreamRelay. On the offering side, subclasses implement
+        _offer_tube() and call new_remote_connection() for each connection
+        the contact opens. On the accepting side, they implement
+        _accept_tube() and _connect_remote(), which is called for each
+        connection the application makes to the tube's socket.
+        """
+        Channel.__init__(self, connection, manager, props)
+
+        self._service = props.get(CHANNEL_TYPE_STREAM_TUBE + '.Service', '')
+        self._parameters = props.get(CHANNEL_INTERFACE_TUBE + '.Parameters',
+            {})
+        if self._requested:
+            self._tube_state = TUBE_CHANNEL_STATE_NOT_OFFERED
+        else:
+            self._tube_state = TUBE_CHANNEL_STATE_LOCAL_PENDING
+        # { socket address type : [socket access control] }
+        self._socket_types = {
+            SOCKET_ADDRESS_TYPE_UNIX: [SOCKET_ACCESS_CONTROL_LOCALHOST],
+            SOCKET_ADDRESS_TYPE_IPV4: [SOCKET_ACCESS_CONTROL_LOCALHOST],
+            SOCKET_ADDRESS_TYPE_IPV6: [SOCKET_ACCESS_CONTROL_LOCALHOST],
+            }
+
+        # the offered service's (address type, address), or the socket
+        # listening for the application on the accepting side
+        self._service_address = None
+        self._listener = None
+
+        self._next_connection_id = 1
+        # { connection ID : StreamRelay }
+        self._relays = {}
+        # { connection ID : local socket waiting for _connect_remote() }
+        self._pending_connections = {}
+        # { connection ID : (local socket, remote socket, watch ID) } for
+        # connections to the offered service which are being established
+        self._connecting = {}
+
+        self._interfaces.add(CHANNEL_INTERFACE_TUBE)
+        self._implement_property_get(CHANNEL_TYPE_STREAM_TUBE, {
+            'Service': lambda: dbus.String(self._service),
+            'SupportedSocketTypes': lambda: dbus.Dictionary(
+                self._socket_types, signature='uau'),
+            })
+        self._implement_property_get(CHANNEL_INTERFACE_TUBE, {
+            'Parameters': lambda: dbus.Dictionary(self._parameters,
+                signature='sv'),
+            'State': lambda: dbus.UInt32(self._tube_state),
+            })
+
+        immutables = {
+            'Service': CHANNEL_TYPE_STREAM_TUBE,
+            'SupportedSocketTypes': CHANNEL_TYPE_STREAM_TUBE,
+            }
+        if not self._requested:
+            immutables['Parameters'] = CHANNEL_INTERFACE_TUBE
+        self._add_immutables(immutables)
+
+    def _check_socket_type(self, address_type, access_control):
+        if access_control not in self._socket_types.get(address_type, ()):
+            raise NotImplemented('socket type %d with access control %d '
+                'is not supported' % (address_type, access_control))
+
+    def set_tube_state(self, state):
+        """Change the State of the tube and emit TubeChannelStateChanged."""
+        if state != self._tube_state:
+            self._tube_state = state
+            self.TubeChannelStateChanged(state)
+
+    @dbus.service.method(CHANNEL_TYPE_STREAM_TUBE, in_signature='uvua{sv}',
+                         out_signature='')
+    def Offer(self, address_type, address, access_control, parameters):
+        if not self._requested or \
+                self._tube_state != TUBE_CHANNEL_STATE_NOT_OFFERED:
+            raise NotAvailable('the tube can not be offered')
+        self._check_socket_type(address_type, access_control)
+
+        self._offer_tube(parameters)
+        self._service_address = (address_type, address)
+        self._parameters = parameters
+        self.set_tube_state(TUBE_CHANNEL_STATE_REMOTE_PENDING)
+
+    def _offer_tube(self, parameters):
+        """
+        Offer the tube to the contact over the protocol, with the given
+        parameters. Subclasses call set_tube_state() once the contact
+        accepts it.
+        """
+        raise NotImplemented('offering stream tubes is not supported')
+
+    def new_remote_connection(self, handle, remote):
+        """
+        Relay a connection opened through the tube by the contact with the
+        given handle, remote being its non-blocking transport socket, to the
+        offered service.
+
+        The service is connected to without blocking, and
+        NewRemoteConnection is emitted once it accepts the connection.
+        Return the ID of the connection, or None if the service could not
+        be reached, in which case remote is closed; remote is also closed if
+        connecting fails later.
+        """
+        address_type, address = self._service_address
+        local = None
+        try:
+            if address_type == SOCKET_ADDRESS_TYPE_UNIX:
+                if not isinstance(address, str):
+                    # an array of bytes
+                    address = ''.join([chr(byte) for byte in address])
+                local = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            else:
+                if address_type == SOCKET_ADDRESS_TYPE_IPV6:
+                    family = socket.AF_INET6
+                else:
+                    family = socket.AF_INET
+                local = socket.socket(family, socket.SOCK_STREAM)
+                address = (str(address[0]), int(address[1]))
+            local.setblocking(False)
+            error = local.connect_ex(address)
+            if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK,
+                             errno.EAGAIN):
+                raise socket.error(error, os.strerror(error))
+        except socket.error, e:
+            self._service_connect_failed(local, remote, e)
+            return None
+
+        id = self._next_connection_id
+        self._next_connection_id += 1
+        if error == 0:
+            self._service_connected(id, handle, local, remote)
+        else:
+            watch_id = gobject.io_add_watch(local,
+                gobject.IO_OUT | gobject.IO_HUP | gobject.IO_ERR,
+                self._service_connect_cb, id, handle, remote)
+            self._connecting[id] = (local, remote, watch_id)
+        return id
+
+    def _service_connect_cb(self, local, condition, id, handle, remote):
+        del self._connecting[id]
+        error = local.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self._service_connect_failed(local, remote,
+                socket.error(error, os.strerror(error)))
+        else:
+            self._service_connected(id, handle, local, remote)
+        return False
+
+    def _service_connected(self, id, handle, local, remote):
+        self._relay(local, remote, id)
+        # the connection parameter is meaningless with localhost access
+        # control
+        self.NewRemoteConnection(handle, dbus.UInt32(0), id)
+
+    def _service_connect_failed(self, local, remote, error):
+        logger.warning('failed to connect to the tube service: %s', error)
+        if local is not None:
+            local.close()
+        remote.close()
+
+    @dbus.service.method(CHANNEL_TYPE_STREAM_TUBE, in_signature='uuv',
+                         out_signature='v')
+    def Accept(self, address_type, access_control, access_control_param):
+        if self._requested or \
+                self._tube_state != TUBE_CHANNEL_STATE_LOCAL_PENDING or \
+                self._listener is not None:
+            raise NotAvailable('the tube is not local pending')
+        self._check_socket_type(address_type, access_control)
+
+        self._listener = SocketListener(address_type, access_control,
+            access_control_param)
+        try:
+            self._accept_tube()
+        except:
+            self._listener.close()
+            self._listener = None
+            raise
+
+        self._listener.accept(self._local_connection_cb)
+        return self._listener.address
+
+    def _accept_tube(self):
+        """
+        Accept the tube over the protocol. Subclasses call set_tube_state()
+        once it is open.
+        """
+        raise NotImplemented('accepting stream tubes is not supported')
+
+    def _local_connection_cb(self, local):
+        id = self._next_connection_id
+        self._next_connection_id += 1
+        self._pending_connections[id] = local
+        self.NewLocalConnection(id)
+        self._connect_remote(id)
+
+    def _connect_remote(self, id):
+        """
+        Open the protocol transport for the local connection with the given
+        ID. Subclasses call relay_connection() with it once it is
+        established, or close_connection() if that fails.
+        """
+        raise NotImplemented('accepting stream tubes is not supported')
+
+    def relay_connection(self, id, remote):
+        """
+        Start relaying the local connection with the given ID over remote,
+        a non-blocking socket.
+        """
+        local = self._pending_connections.pop(id)
+        self._relay(local, remote, id)
+
+    def _relay(self, local, remote, id=None):
+        if id is None:
+            id = self._next_connection_id
+            self._next_connection_id += 1
+
+        def closed_cb(error):
+            del self._relays[id]
+            if error is None:
+                self.ConnectionClosed(id, Cancelled._dbus_error_name,
+                    'connection closed')
+            else:
+                self.ConnectionClosed(id, _CONNECTION_LOST, str(error))
+
+        relay = StreamRelay(local, remote, closed_cb)
+        self._relays[id] = relay
+        relay.start()
+        return id
+
+    def close_connection(self, id, error=Cancelled._dbus_error_name,
+                         message=''):
+        """
+        Close the connection with the given ID, and emit ConnectionClosed
+        with the given D-Bus error name and debug message.
+        """
+        if id in self._connecting:
+            # NewRemoteConnection has not been emitted for it yet
+            local, remote, watch_id = self._connecting.pop(id)
+            gobject.source_remove(watch_id)
+            local.close()
+            remote.close()
+            return
+
+        relay = self._relays.pop(id, None)
+        if relay is not None:
+            relay.close()
+        else:
+            self._pending_connections.pop(id).close()
+        self.ConnectionClosed(id, error, message)
+
+    @dbus.service.method(CHANNEL_INTERFACE, in_signature='', out_signature='')
+    def Close(self):
+        for relay in self._relays.values():
+            relay.close()
+        self._relays.clear()
+        for local in self._pending_connections.values():
+            local.close()
+        self._pending_connections.clear()
+        for local, remote, watch_id in self._connecting.values():
+            gobject.source_remove(watch_id)
+            local.close()
+            remote.close()
+        self._connecting.clear()
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+        Channel.Close(self)
+
+
+
+from telepathy._generated.Channel_Type_DBus_Tube \
+        import ChannelTypeDBusTube as _ChannelTypeDBusTubeIface
+
+class ChannelTypeDBusTube(Channel, _ChannelTypeDBusTubeIface,
+                          _ChannelInterfaceTube):
+    __doc__ = _ChannelTypeDBusTubeIface.__doc__
 
     def __init__(self, connection, manager, props):
         """
@@ -182,9 +884,248 @@ class ChannelTypeFileTransfer(Channel, _ChannelTypeFileTransferIface):
 
         Parameters:
         connection - the parent Telepathy Connection object
+
+        The tube's private bus is carried over a single protocol stream by a
+        DBusTubeMultiplexer, which batches the application's messages into
+        frames. Subclasses implement _offer_tube() or _accept_tube(), and
+        _send_frame() to send a frame to one or all of the participants;
+        they call receive_frame() with the frames the participants send,
+        and add_dbus_names() and remove_dbus_names() as they join and leave.
         """
         Channel.__init__(self, connection, manager, props)
 
+        self._service_name = props.get(
+            CHANNEL_TYPE_DBUS_TUBE + '.ServiceName', '')
+        self._parameters = props.get(CHANNEL_INTERFACE_TUBE + '.Parameters',
+            {})
+        if self._requested:
+            self._tube_state = TUBE_CHANNEL_STATE_NOT_OFFERED
+        else:
+            self._tube_state = TUBE_CHANNEL_STATE_LOCAL_PENDING
+        self._access_controls = [SOCKET_ACCESS_CONTROL_CREDENTIALS,
+                                 SOCKET_ACCESS_CONTROL_LOCALHOST]
+
+        # { handle : unique name } and { unique name : handle }
+        self._dbus_names = {}
+        self._dbus_name_handles = {}
+
+        self._listener = None
+        self._access_control = None
+        self._multiplexer = None
+        # (handle, frame) received before the application connected
+        self._pending_frames = []
+
+        self._interfaces.add(CHANNEL_INTERFACE_TUBE)
+        self._implement_property_get(CHANNEL_TYPE_DBUS_TUBE, {
+            'ServiceName': lambda: dbus.String(self._service_name),
+            'DBusNames': lambda: dbus.Dictionary(self._dbus_names,
+                signature='us'),
+            'SupportedAccessControls': lambda: dbus.Array(
+                self._access_controls, signature='u'),
+            })
+        self._implement_property_get(CHANNEL_INTERFACE_TUBE, {
+            'Parameters': lambda: dbus.Dictionary(self._parameters,
+                signature='sv'),
+            'State': lambda: dbus.UInt32(self._tube_state),
+            })
+
+        immutables = {
+            'ServiceName': CHANNEL_TYPE_DBUS_TUBE,
+            'SupportedAccessControls': CHANNEL_TYPE_DBUS_TUBE,
+            }
+        if not self._requested:
+            immutables['Parameters'] = CHANNEL_INTERFACE_TUBE
+        self._add_immutables(immutables)
+
+    def set_tube_state(self, state):
+        """Change the State of the tube and emit TubeChannelStateChanged."""
+        if state != self._tube_state:
+            self._tube_state = state
+            self.TubeChannelStateChanged(state)
+
+    def add_dbus_names(self, names):
+        """
+        Add participants to the tube, names being a dict mapping their
+        handles to their unique names on its bus, and emit
+        DBusNamesChanged.
+        """
+        added = {}
+        removed = []
+        for handle, name in names.iteritems():
+            old = self._dbus_names.get(handle)
+            if old == name:
+                continue
+            if old is not None:
+                del self._dbus_name_handles[old]
+            other = self._dbus_name_handles.get(name)
+            if other is not None:
+                # the name has moved to another participant
+                del self._dbus_names[other]
+                removed.append(other)
+            self._dbus_names[handle] = name
+            self._dbus_name_handles[name] = handle
+            added[handle] = name
+
+        if added or removed:
+            self.DBusNamesChanged(dbus.Dictionary(added, signature='us'),
+                dbus.Array(removed, signature='u'))
+
+    def remove_dbus_names(self, handles):
+        """
+        Remove the participants with the given handles from the tube, and
+        emit DBusNamesChanged.
+        """
+        removed = []
+        for handle in handles:
+            name = self._dbus_names.pop(handle, None)
+            if name is not None:
+                del self._dbus_name_handles[name]
+                removed.append(handle)
+
+        if removed:
+            self.DBusNamesChanged(dbus.Dictionary({}, signature='us'),
+                dbus.Array(removed, signature='u'))
+
+    def get_dbus_name_handle(self, name):
+        """
+        Return the handle of the participant with the given unique name, or
+        None if there is none.
+        """
+        return self._dbus_name_handles.get(name)
+
+    def _listen(self, access_control):
+        if access_control not in self._access_controls:
+            raise NotImplemented('access control %d is not supported'
+                % access_control)
+
+        # the credentials are checked by the D-Bus authentication
+        self._listener = SocketListener(SOCKET_ADDRESS_TYPE_UNIX,
+            SOCKET_ACCESS_CONTROL_LOCALHOST, 0)
+        self._access_control = access_control
+        return 'unix:path=%s' % str(self._listener.address)
+
+    def _close_listener(self):
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+
+    @dbus.service.method(CHANNEL_TYPE_DBUS_TUBE, in_signature='a{sv}u',
+                         out_signature='s')
+    def Offer(self, parameters, access_control):
+        if not self._requested or \
+                self._tube_state != TUBE_CHANNEL_STATE_NOT_OFFERED:
+            raise NotAvailable('the tube can not be offered')
+
+        address = self._listen(access_control)
+        try:
+            self._offer_tube(parameters)
+        except:
+            self._close_listener()
+            raise
+
+        self._listener.accept(self._local_connection_cb)
+        self._parameters = parameters
+        self.set_tube_state(TUBE_CHANNEL_STATE_REMOTE_PENDING)
+        return address
+
+    def _offer_tube(self, parameters):
+        """
+        Offer the tube to the contact or room over the protocol, with the
+        given parameters. Subclasses call set_tube_state() once it is open.
+        """
+        raise NotImplemented('offering D-Bus tubes is not supported')
+
+    @dbus.service.method(CHANNEL_TYPE_DBUS_TUBE, in_signature='u',
+                         out_signature='s')
+    def Accept(self, access_control):
+        if self._requested or \
+                self._tube_state != TUBE_CHANNEL_STATE_LOCAL_PENDING or \
+                self._listener is not None:
+            raise NotAvailable('the tube is not local pending')
+
+        address = self._listen(access_control)
+        try:
+            self._accept_tube()
+        except:
+            self._close_listener()
+            raise
+
+        self._listener.accept(self._local_connection_cb)
+        return address
+
+    def _accept_tube(self):
+        """
+        Accept the tube over the protocol. Subclasses call set_tube_state()
+        once it is open.
+        """
+        raise NotImplemented('accepting D-Bus tubes is not supported')
+
+    def _local_connection_cb(self, local):
+        # only one application can be on the tube's bus
+        self._close_listener()
+
+        self._multiplexer = DBusTubeMultiplexer(local, self._frame_ready_cb,
+            self._local_closed_cb,
+            self._access_control == SOCKET_ACCESS_CONTROL_CREDENTIALS)
+        self._multiplexer.start()
+
+        pending = self._pending_frames
+        self._pending_frames = []
+        for handle, frame in pending:
+            self.receive_frame(handle, frame)
+
+    def _frame_ready_cb(self, destination, frame):
+        if destination is None:
+            self._send_frame(None, frame)
+            return
+
+        handle = self._dbus_name_handles.get(destination)
+        if handle is None:
+            logger.warning('dropping D-Bus tube messages for unknown name %s',
+                destination)
+        else:
+            self._send_frame(handle, frame)
+
+    def _send_frame(self, handle, frame):
+        """
+        Send a frame of D-Bus messages from the application over the
+        protocol, to the participant with the given handle, or to all of
+        them if handle is None.
+        """
+        raise NotImplemented('sending over D-Bus tubes is not supported')
+
+    def receive_frame(self, handle, frame):
+        """
+        Pass a frame of D-Bus messages received over the protocol from the
+        participant with the given handle to the application.
+        """
+        if self._multiplexer is None:
+            if self._listener is None:
+                logger.warning('dropping D-Bus tube frame from %d: no '
+                    'application is connected', handle)
+            else:
+                # the application has not connected yet
+                self._pending_frames.append((handle, frame))
+            return
+
+        self._multiplexer.deliver(frame, self._dbus_names.get(handle))
+
+    def _local_closed_cb(self, error):
+        self._multiplexer = None
+        if error is not None:
+            logger.warning('D-Bus tube connection failed: %s', error)
+        # the application left the tube's bus
+        self.Close()
+
+    @dbus.service.method(CHANNEL_INTERFACE, in_signature='', out_signature='')
+    def Close(self):
+        if self._multiplexer is not None:
+            self._multiplexer.flush()
+            self._multiplexer.close()
+            self._multiplexer = None
+        self._close_listener()
+        self._pending_frames = []
+        Channel.Close(self)
 
 from telepathy._generated.Channel_Type_Streamed_Media \
         import ChannelTypeStreamedMedia as _ChannelTypeStreamedMediaIface
@@ -218,8 +1159,11 @@ class ChannelTypeRoomList(Channel, _ChannelTypeRoomListIface):
         Channel.__init__(self, connection, manager, props)
         self._listing_rooms = False
         self._rooms = {}
+        self._server = props.get(CHANNEL_TYPE_ROOM_LIST + '.Server', '')
 
-        self._add_immutables(self, {'Server': CHANNEL_TYPE_ROOM_LIST})
+        self._implement_property_get(CHANNEL_TYPE_ROOM_LIST,
+            {'Server': lambda: dbus.String(self._server)})
+        self._add_immutables({'Server': CHANNEL_TYPE_ROOM_LIST})
 
     @dbus.service.method(CHANNEL_TYPE_ROOM_LIST, in_signature='', out_signature='b')
     def GetListingRooms(self):
@@ -236,6 +1180,12 @@ from telepathy._generated.Channel_Type_Text \
 class ChannelTypeText(Channel, _ChannelTypeTextIface):
     __doc__ = _ChannelTypeTextIface.__doc__
 
+    # Subclasses can set these to keep only this many pending message
+    # texts in memory, writing the others to a file in the given directory
+    # (see PendingMessageQueue).
+    _pending_spill_threshold = None
+    _pending_spill_dir = None
+
     def __init__(self, connection, manager, props):
         """
         Initialise the channel.
@@ -245,7 +1195,8 @@ class ChannelTypeText(Channel, _ChannelTypeTextIface):
         """
         Channel.__init__(self, connection, manager, props)
 
-        self._pending_messages = {}
+        self._pending_messages = PendingMessageQueue(
+            self._pending_spill_threshold, self._pending_spill_dir)
         self._message_types = [CHANNEL_TEXT_MESSAGE_TYPE_NORMAL]
 
     @dbus.service.method(CHANNEL_TYPE_TEXT, in_signature='', out_signature='au')
@@ -271,12 +1222,10 @@ class ChannelTypeText(Channel, _ChannelTypeTextIface):
         Possible Errors:
         InvalidArgument (a given message ID was not found, no action taken)
         """
-        for id in ids:
-            if id not in self._pending_messages:
-                raise InvalidArgument("the given message ID was not found")
-
-        for id in ids:
-            del self._pending_messages[id]
+        try:
+            self._pending_messages.acknowledge(ids)
+        except KeyError:
+            raise InvalidArgument("the given message ID was not found")
 
     @dbus.service.method(CHANNEL_TYPE_TEXT, in_signature='b', out_signature='a(uuuuus)')
     def ListPendingMessages(self, clear):
@@ -296,19 +1245,14 @@ class ChannelTypeText(Channel, _ChannelTypeTextIface):
             a bitwise OR of the message flags
             a string of the text of the message
         """
-        messages = []
-        for id in self._pending_messages.keys():
-            (timestamp, sender, type, flags, text) = self._pending_messages[id]
-            message = (id, timestamp, sender, type, flags, text)
-            messages.append(message)
-            if clear:
-                del self._pending_messages[id]
-        messages.sort(cmp=lambda x,y:cmp(x[1], y[1]))
+        messages = self._pending_messages.list()
+        if clear:
+            self._pending_messages.clear()
         return messages
 
     @dbus.service.signal(CHANNEL_TYPE_TEXT, signature='uuuuus')
     def Received(self, id, timestamp, sender, type, flags, text):
-        self._pending_messages[id] = (timestamp, sender, type, flags, text)
+        self._pending_messages.add(id, timestamp, sender, type, flags, text)
 
 
 from telepathy._generated.Channel_Interface_Chat_State \
@@ -321,6 +1265,11 @@ from telepathy._generated.Channel_Interface_DTMF import ChannelInterfaceDTMF
 from telepathy._generated.Channel_Interface_Group \
         import ChannelInterfaceGroup as _ChannelInterfaceGroup
 
+# states of a handle in a group
+_GROUP_MEMBER = 0
+_GROUP_LOCAL_PENDING = 1
+_GROUP_REMOTE_PENDING = 2
+
 class ChannelInterfaceGroup(_ChannelInterfaceGroup, DBusProperties):
 
     def __init__(self):
@@ -329,14 +1278,76 @@ class ChannelInterfaceGroup(_ChannelInterfaceGroup, DBusProperties):
 
         self._implement_property_get(CHANNEL_INTERFACE_GROUP,
             {'GroupFlags': lambda: dbus.UInt32(self.GetGroupFlags()),
-             'Members': lambda: dbus.Array(self.GetMembers(), signature='u'),
-             'RemotePendingMembers': lambda: dbus.Array(self.GetRemotePendingMembers(), signature='u'),
+             'Members': lambda: self.GetMembers(),
+             'RemotePendingMembers': lambda: self.GetRemotePendingMembers(),
              'SelfHandle': lambda: dbus.UInt32(self.GetSelfHandle())})
 
         self._group_flags = 0
-        self._members = set()
-        self._local_pending = set()
-        self._remote_pending = set()
+        # { handle : _GROUP_MEMBER, _GROUP_LOCAL_PENDING or
+        #   _GROUP_REMOTE_PENDING }
+        self._member_states = {}
+        # dbus.Array of the handles in each state, or None if it needs to
+        # be rebuilt
+        self._member_arrays = [None, None, None]
+        # (array, frozenset) for each state, the frozenset being built from
+        # the array and thrown away when the array is rebuilt
+        self._member_sets = [None, None, None]
+
+        # [((message, actor, reason), { handle : change })] waiting to be
+        # emitted, where change is one of the MembersChanged arguments
+        self._queued_member_changes = []
+        self._member_changes_id = None
+        # True while flush_members_changed() emits changes which have
+        # already been applied
+        self._flushing_member_changes = False
+
+    def _get_member_array(self, state):
+        arrays = self._member_arrays
+        if arrays[state] is None:
+            handles = ([], [], [])
+            for handle, handle_state in self._member_states.iteritems():
+                handles[handle_state].append(handle)
+            for i in (_GROUP_MEMBER, _GROUP_LOCAL_PENDING,
+                      _GROUP_REMOTE_PENDING):
+                if arrays[i] is None:
+                    arrays[i] = dbus.Array(handles[i], signature='u')
+        return arrays[state]
+
+    def _get_member_set(self, state):
+        array = self._get_member_array(state)
+        cached = self._member_sets[state]
+        if cached is None or cached[0] is not array:
+            cached = (array, frozenset(array))
+            self._member_sets[state] = cached
+        return cached[1]
+
+    # frozensets of the handles in each state, replaced on every change
+    _members = property(lambda self: self._get_member_set(_GROUP_MEMBER))
+    _local_pending = property(
+        lambda self: self._get_member_set(_GROUP_LOCAL_PENDING))
+    _remote_pending = property(
+        lambda self: self._get_member_set(_GROUP_REMOTE_PENDING))
+
+    def _apply_members_changed(self, added, removed, local_pending,
+                               remote_pending):
+        states = self._member_states
+        arrays = self._member_arrays
+
+        for handles, state in ((local_pending, _GROUP_LOCAL_PENDING),
+                               (remote_pending, _GROUP_REMOTE_PENDING),
+                               (added, _GROUP_MEMBER)):
+            for handle in handles:
+                old = states.get(handle)
+                if old != state:
+                    if old is not None:
+                        arrays[old] = None
+                    states[handle] = state
+                    arrays[state] = None
+
+        for handle in removed:
+            old = states.pop(handle, None)
+            if old is not None:
+                arrays[old] = None
 
     @dbus.service.method(CHANNEL_INTERFACE_GROUP, in_signature='', out_signature='u')
     def GetGroupFlags(self):
@@ -349,43 +1360,102 @@ class ChannelInterfaceGroup(_ChannelInterfaceGroup, DBusProperties):
 
     @dbus.service.method(CHANNEL_INTERFACE_GROUP, in_signature='', out_signature='au')
     def GetMembers(self):
-        return self._members
+        return self._get_member_array(_GROUP_MEMBER)
 
     @dbus.service.method(CHANNEL_INTERFACE_GROUP, in_signature='', out_signature='u')
     def GetSelfHandle(self):
         self_handle = self._conn.GetSelfHandle()
-        if (self_handle in self._members or
-            self_handle in self._local_pending or
-            self_handle in self._remote_pending):
+        if self_handle in self._member_states:
             return self_handle
         else:
             return 0
 
     @dbus.service.method(CHANNEL_INTERFACE_GROUP, in_signature='', out_signature='au')
     def GetLocalPendingMembers(self):
-        return self._local_pending
+        return self._get_member_array(_GROUP_LOCAL_PENDING)
 
     @dbus.service.method(CHANNEL_INTERFACE_GROUP, in_signature='', out_signature='au')
     def GetRemotePendingMembers(self):
-        return self._remote_pending
+        return self._get_member_array(_GROUP_REMOTE_PENDING)
 
     @dbus.service.method(CHANNEL_INTERFACE_GROUP, in_signature='', out_signature='auauau')
     def GetAllMembers(self):
-        return (self._members, self._local_pending, self._remote_pending)
-
-    @dbus.service.signal(CHANNEL_INTERFACE_GROUP, signature='sauauauauuu')
-    def MembersChanged(self, message, added, removed, local_pending, remote_pending, actor, reason):
+        return (self._get_member_array(_GROUP_MEMBER),
+                self._get_member_array(_GROUP_LOCAL_PENDING),
+                self._get_member_array(_GROUP_REMOTE_PENDING))
 
-        self._members.update(added)
-        self._members.difference_update(removed)
+    def queue_members_changed(self, message, added, removed, local_pending,
+                              remote_pending, actor, reason):
+        """
+        Change the members of the group like MembersChanged, but emit the
+        signal from an idle callback. Changes queued during the same main
+        loop iteration with the same message, actor and reason are merged
+        into a single MembersChanged signal, in which only the last change
+        queued for each handle appears.
+        """
+        self._apply_members_changed(added, removed, local_pending,
+                                    remote_pending)
 
-        self._local_pending.update(local_pending)
-        self._local_pending.difference_update(added)
-        self._local_pending.difference_update(removed)
+        key = (message, actor, reason)
+        queue = self._queued_member_changes
+        if queue and queue[-1][0] == key:
+            changes = queue[-1][1]
+        else:
+            changes = {}
+            queue.append((key, changes))
+
+        for handles, change in ((local_pending, 'local_pending'),
+                                (remote_pending, 'remote_pending'),
+                                (added, 'added'),
+                                (removed, 'removed')):
+            for handle in handles:
+                changes[handle] = change
+
+        if self._member_changes_id is None:
+            self._member_changes_id = \
+                gobject.idle_add(self._member_changes_idle_cb)
+
+    def _member_changes_idle_cb(self):
+        self._member_changes_id = None
+        self.flush_members_changed()
+        return False
+
+    def flush_members_changed(self):
+        """
+        Emit the MembersChanged signals for the changes queued with
+        queue_members_changed() now.
+        """
+        if self._member_changes_id is not None:
+            gobject.source_remove(self._member_changes_id)
+            self._member_changes_id = None
+
+        queue = self._queued_member_changes
+        self._queued_member_changes = []
+
+        # queue_members_changed() has already applied these changes, so
+        # MembersChanged must only signal them
+        self._flushing_member_changes = True
+        try:
+            for (message, actor, reason), changes in queue:
+                handles = {'added': [], 'removed': [], 'local_pending': [],
+                           'remote_pending': []}
+                for handle, change in changes.iteritems():
+                    handles[change].append(handle)
+                self.MembersChanged(message, handles['added'],
+                    handles['removed'], handles['local_pending'],
+                    handles['remote_pending'], actor, reason)
+        finally:
+            self._flushing_member_changes = False
 
-        self._remote_pending.update(remote_pending)
-        self._remote_pending.difference_update(added)
-        self._remote_pending.difference_update(removed)
+    @dbus.service.signal(CHANNEL_INTERFACE_GROUP, signature='sauauauauuu')
+    def MembersChanged(self, message, added, removed, local_pending, remote_pending, actor, reason):
+        if not self._flushing_member_changes:
+            # signal the queued changes, which happened first, before this
+            # one
+            if self._queued_member_changes:
+                self.flush_members_changed()
+            self._apply_members_changed(added, removed, local_pending,
+                                        remote_pending)
 
 
 from telepathy._generated.Channel_Interface_Hold import ChannelInterfaceHold
@@ -26,26 +26,40 @@ class ChannelManager(object):
         self._conn = connection
 
         self._requestable_channel_classes = dict()
+        # { channel type : { handle : [channel, ...] } }
         self._channels = dict()
+        # { channel : (channel type, handle) }
+        self._channel_keys = dict()
         self._fixed_properties = dict()
         self._available_properties = dict()
 
     def close(self):
         """Close channel manager and all the existing channels."""
-        for channel_type in self._requestable_channel_classes:
-            for channels in self._channels[channel_type].values():
-                for channel in channels:
-                    if channel._type == CHANNEL_TYPE_CONTACT_LIST:
-                        channel.remove_from_connection()
-                    else:
-                        channel.Close()
+        channels = self._channel_keys.keys()
+
+        # forget every channel up front so Close() doesn't have to find them
+        self._channel_keys.clear()
+        for buckets in self._channels.itervalues():
+            buckets.clear()
+
+        for channel in channels:
+            if channel._type == CHANNEL_TYPE_CONTACT_LIST:
+                channel.remove_from_connection()
+            else:
+                channel.Close()
 
     def remove_channel(self, channel):
         "Remove channel from the channel manager"
-        for channel_type in self._requestable_channel_classes:
-            for handle, channels in self._channels[channel_type].items():
-                if channel in channels :
-                    channels.remove(channel)
+        key = self._channel_keys.pop(channel, None)
+        if key is None:
+            return
+
+        type, handle = key
+        buckets = self._channels[type]
+        channels = buckets[handle]
+        channels.remove(channel)
+        if not channels:
+            del buckets[handle]
 
     def _get_type_requested_handle(self, props):
         """Return the type, request and target handle from the requested
@@ -69,10 +83,11 @@ class ChannelManager(object):
 
         type, _, handle = self._get_type_requested_handle(props)
 
-        if type in self._channels:
-            if handle in self._channels[type]:
-                if len(self._channels[type][handle]) > 0:
-                    return self._channels[type][handle][-1]
+        buckets = self._channels.get(type)
+        if buckets:
+            channels = buckets.get(handle)
+            if channels:
+                return channels[-1]
 
         return None
 
@@ -93,6 +108,7 @@ class ChannelManager(object):
         self._conn.add_channels([channel], signal=signal)
         if type in self._channels:
             self._channels[type].setdefault(handle, []).append(channel)
+            self._channel_keys[channel] = (type, handle)
 
         return channel
 
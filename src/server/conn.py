@@ -20,11 +20,16 @@
 
 import dbus
 import dbus.service
+import gobject
+import logging
+import Queue
 import re
-import weakref
+import threading
+import traceback
 
 from telepathy.constants import (CONNECTION_STATUS_DISCONNECTED,
                                  CONNECTION_STATUS_CONNECTED,
+                                 CONNECTION_PRESENCE_TYPE_UNKNOWN,
                                  HANDLE_TYPE_NONE,
                                  HANDLE_TYPE_CONTACT,
                                  LAST_HANDLE_TYPE)
@@ -37,13 +42,17 @@ from telepathy.interfaces import (CONN_INTERFACE,
                                   CONN_INTERFACE_CAPABILITIES,
                                   CONN_INTERFACE_PRESENCE,
                                   CONN_INTERFACE_RENAMING,
+                                  CONNECTION_INTERFACE_CONTACTS,
                                   CONNECTION_INTERFACE_REQUESTS,
+                                  CONNECTION_INTERFACE_SIMPLE_PRESENCE,
                                   CHANNEL_INTERFACE)
-from telepathy.server.handle import Handle
+from telepathy.server.handle import Handle, HandleRepository
 from telepathy.server.properties import DBusProperties
 
 from telepathy._generated.Connection import Connection as _Connection
 
+logger = logging.getLogger('telepathy.server.conn')
+
 _BAD = re.compile(r'(?:^[0-9])|(?:[^A-Za-z0-9])')
 
 def _escape_as_identifier(name):
@@ -98,12 +107,20 @@ class Connection(_Connection, DBusProperties):
 
         self._status = CONNECTION_STATUS_DISCONNECTED
 
-        self._handles = weakref.WeakValueDictionary()
+        self._handles = HandleRepository(self._handle_removed)
         self._next_handle_id = 1
+        # { client unique name : set((handle type, handle id)) }
         self._client_handles = {}
+        self._handle_sweep_id = None
 
         self._channels = set()
         self._next_channel_id = 0
+        # channels waiting to be announced, in creation order; those closed
+        # in the meantime are only removed from the set, and skipped when
+        # the signals are emitted
+        self._new_channels = []
+        self._new_channels_set = set()
+        self._new_channels_id = None
 
     def check_parameters(self, parameters):
         """
@@ -148,32 +165,139 @@ class Connection(_Connection, DBusProperties):
 
     def check_handle(self, handle_type, handle):
         if (handle_type, handle) not in self._handles:
-            print "Connection.check_handle", handle, handle_type, self._handles.keys()
-            print str(list( [ self._handles[x] for x in self._handles.keys() ] ) )
             raise InvalidHandle('handle number %d not valid for type %d' %
                 (handle, handle_type))
 
+    def check_handles(self, handle_type, handles):
+        """
+        Check that all of the given handle numbers are valid for handle_type
+        and return the corresponding Handle objects, in the same order.
+        Raises InvalidHandle listing every invalid handle number.
+        """
+        get = self._handles.get
+        ret = []
+        invalid = []
+        for handle in handles:
+            hand = get((handle_type, handle))
+            if hand is None:
+                invalid.append(handle)
+            ret.append(hand)
+
+        if invalid:
+            raise InvalidHandle('handle numbers %s not valid for type %d' %
+                (', '.join([str(int(handle)) for handle in invalid]),
+                 handle_type))
+
+        return ret
+
     def check_handle_type(self, type):
         if (type <= HANDLE_TYPE_NONE or type > LAST_HANDLE_TYPE):
             raise InvalidArgument('handle type %s not known' % type)
 
+    def normalize_handle_name(self, handle_type, name):
+        """
+        Return the canonical form of name for a handle of the given type.
+        Handles are looked up by their normalised name, so subclasses for
+        protocols where several spellings refer to the same contact or
+        room should override this. The default implementation returns
+        name unchanged.
+        """
+        return name
+
     def get_handle_id(self):
         id = self._next_handle_id
         self._next_handle_id += 1
         return id
 
     def add_client_handle(self, handle, sender):
-        if sender in self._client_handles:
-            self._client_handles[sender].add((handle.get_type(), handle))
+        key = (handle.get_type(), handle.get_id())
+        held = self._client_handles.setdefault(sender, set())
+        # holding a handle is idempotent for a given client
+        if key not in held:
+            held.add(key)
+            self._handles.hold(key)
+
+    def release_client_handle(self, key, sender):
+        self._client_handles[sender].remove(key)
+        if self._handles.release(key):
+            self._queue_handle_sweep()
+
+    def _queue_handle_sweep(self):
+        if self._handle_sweep_id is None:
+            self._handle_sweep_id = gobject.idle_add(self._sweep_handles)
+
+    def _sweep_handles(self):
+        self._handle_sweep_id = None
+        self._handles.sweep()
+        return False # when called in an idle callback
+
+    def _handle_removed(self, key):
+        # clients can't release a handle which has been deleted
+        for held in self._client_handles.itervalues():
+            held.discard(key)
+
+        handle_type, handle = key
+        if handle_type != HANDLE_TYPE_CONTACT:
+            return
+        # the handle number may be reused for another contact
+        for cache in getattr(self, '_contact_attribute_cache', {}).values():
+            cache.pop(handle, None)
+
+    def get_handle_statistics(self):
+        """
+        Return a dict with the number of 'live' handles, of handles 'held'
+        by clients and of handles 'reclaimed' since the connection was
+        created.
+        """
+        return self._handles.get_statistics()
+
+    def _implement_contact_attributes(self, iface, provider):
+        """
+        Register the contact attributes of iface for the Contacts interface.
+
+        provider is called with a list of valid contact handle numbers and
+        returns a dict mapping some or all of them to a dict of attribute
+        names (without the interface prefix) to values. The attributes of
+        each handle are remembered until _contact_attributes_changed() is
+        called for it, or the handle is freed.
+        """
+        if getattr(self, '_contact_attribute_providers', None) is None:
+            self._contact_attribute_providers = {}
+            self._contact_attribute_cache = {}
+        self._contact_attribute_providers[iface] = provider
+        self._contact_attribute_cache[iface] = {}
+
+    def _contact_attributes_changed(self, iface, handles=None):
+        """
+        Forget the remembered contact attributes of iface for the given
+        handle numbers, or for all contacts if handles is None.
+        """
+        cache = getattr(self, '_contact_attribute_cache', {}).get(iface)
+        if cache is None:
+            return
+        if handles is None:
+            cache.clear()
         else:
-            self._client_handles[sender] = set([(handle.get_type(), handle)])
+            for handle in handles:
+                cache.pop(handle, None)
+
+    def _get_contact_attributes(self, iface, handles):
+        cache = self._contact_attribute_cache[iface]
+        missing = [handle for handle in handles if handle not in cache]
+        if missing:
+            attributes = self._contact_attribute_providers[iface](missing)
+            for handle in missing:
+                cache[handle] = attributes.get(handle, {})
+        return cache
 
     def name_owner_changed_callback(self, name, old_owner, new_owner):
         # when name and old_owner are the same, and new_owner is
         # blank, it is the client itself releasing its name... aka exiting
         if (name == old_owner and new_owner == "" and name in self._client_handles):
             print "deleting handles for", name
-            del self._client_handles[name]
+            for key in self._client_handles.pop(name):
+                if self._handles.release(key):
+                    self._queue_handle_sweep()
 
     def set_self_handle(self, handle):
         self._self_handle = handle
@@ -185,17 +309,58 @@ class Connection(_Connection, DBusProperties):
 
     def add_channels(self, channels, signal=True):
         """ add new channels and signal their creation"""
-        signal_channels = set()
+        signal_channels = []
 
         for channel in channels:
             if channel not in self._channels:
                 self._channels.add(channel)
-                signal_channels.add(channel)
+                signal_channels.append(channel)
 
         if signal:
             self.signal_new_channels(signal_channels)
 
     def signal_new_channels(self, channels):
+        """
+        Queue NewChannels and NewChannel to be emitted for the given
+        channels. The channels queued during one main loop iteration are
+        announced together from an idle callback, which also guarantees that
+        replies to CreateChannel and EnsureChannel are sent first.
+        """
+        for channel in channels:
+            if channel not in self._new_channels_set:
+                self._new_channels_set.add(channel)
+                self._new_channels.append(channel)
+
+        if self._new_channels and self._new_channels_id is None:
+            self._new_channels_id = gobject.idle_add(self._new_channels_idle_cb)
+
+    def _new_channels_idle_cb(self):
+        self._new_channels_id = None
+        self.flush_new_channels()
+        return False
+
+    def flush_new_channels(self):
+        """
+        Emit the signals for all the channels queued by
+        signal_new_channels() now, rather than waiting for the idle callback.
+        """
+        if self._new_channels_id is not None:
+            gobject.source_remove(self._new_channels_id)
+            self._new_channels_id = None
+
+        pending = self._new_channels_set
+        channels = []
+        for channel in self._new_channels:
+            if channel in pending:
+                pending.discard(channel)
+                channels.append(channel)
+
+        self._new_channels = []
+        self._new_channels_set = set()
+
+        if not channels:
+            return
+
         self.NewChannels([(channel._object_path, channel.get_props())
             for channel in channels])
 
@@ -213,6 +378,10 @@ class Connection(_Connection, DBusProperties):
 
     def remove_channel(self, channel):
         self._channels.remove(channel)
+        if channel in self._new_channels_set:
+            # closed before it was announced, so clients never knew about it
+            self._new_channels_set.remove(channel)
+            return
         self.ChannelClosed(channel._object_path)
 
     @dbus.service.method(CONN_INTERFACE, in_signature='', out_signature='as')
@@ -229,14 +398,8 @@ class Connection(_Connection, DBusProperties):
         self.check_connected()
         self.check_handle_type(handle_type)
 
-        for handle in handles:
-            self.check_handle(handle_type, handle)
-
-        ret = []
-        for handle in handles:
-            ret.append(self._handles[handle_type, handle].get_name())
-
-        return ret
+        return [hand.get_name()
+                for hand in self.check_handles(handle_type, handles)]
 
     @dbus.service.method(CONN_INTERFACE, in_signature='uas', out_signature='au', sender_keyword='sender')
     def RequestHandles(self, handle_type, names, sender):
@@ -245,15 +408,13 @@ class Connection(_Connection, DBusProperties):
 
         ret = []
         for name in names:
-            handle = None
-            for candidate in self._handles.values():
-                if candidate.get_name() == name:
-                    handle = candidate
-                    break
+            name = self.normalize_handle_name(handle_type, name)
+            handle = self._handles.lookup(handle_type, name)
 
-            if not handle:
+            if handle is None:
                 id = self.get_handle_id()
-                handle = Handle(id, handle_type, name)
+                handle = Handle(id, handle_type,
+                                self._handles.intern_name(handle_type, name))
                 self._handles[handle_type, id] = handle
 
             self.add_client_handle(handle, sender)
@@ -266,11 +427,7 @@ class Connection(_Connection, DBusProperties):
         self.check_connected()
         self.check_handle_type(handle_type)
 
-        for handle in handles:
-            self.check_handle(handle_type, handle)
-
-        for handle in handles:
-            hand = self._handles[handle_type, handle]
+        for hand in self.check_handles(handle_type, handles):
             self.add_client_handle(hand, sender)
 
     @dbus.service.method(CONN_INTERFACE, in_signature='uau', out_signature='', sender_keyword='sender')
@@ -278,18 +435,17 @@ class Connection(_Connection, DBusProperties):
         self.check_connected()
         self.check_handle_type(handle_type)
 
+        self.check_handles(handle_type, handles)
+
+        held = self._client_handles.get(sender)
         for handle in handles:
-            self.check_handle(handle_type, handle)
-            hand = self._handles[handle_type, handle]
-            if sender in self._client_handles:
-                if (handle_type, hand) not in self._client_handles[sender]:
-                    raise NotAvailable('client is not holding handle %s of type %s' % (handle, handle_type))
-            else:
+            if held is None:
                 raise NotAvailable('client does not hold any handles')
+            if (handle_type, handle) not in held:
+                raise NotAvailable('client is not holding handle %s of type %s' % (handle, handle_type))
 
-        for handle in handles:
-            hand = self._handles[handle_type, handle]
-            self._client_handles[sender].remove((handle_type, hand))
+        for handle in set(handles):
+            self.release_client_handle((handle_type, handle), sender)
 
     @dbus.service.method(CONN_INTERFACE, in_signature='', out_signature='u')
     def GetSelfHandle(self):
@@ -315,11 +471,275 @@ class Connection(_Connection, DBusProperties):
 
 
 from telepathy._generated.Connection_Interface_Aliasing \
-        import ConnectionInterfaceAliasing
+        import ConnectionInterfaceAliasing as _ConnectionInterfaceAliasing
+
+class ConnectionInterfaceAliasing(_ConnectionInterfaceAliasing):
+    """
+    Keeps a table of contact aliases, answers RequestAliases and GetAliases
+    from it, and reports the identifier of contacts without an alias as
+    their alias. Subclasses fill the table with set_aliases() when the
+    roster is loaded, and with queue_aliases_changed() or AliasesChanged as
+    aliases change.
+    """
+
+    def __init__(self):
+        _ConnectionInterfaceAliasing.__init__(self)
+        # { contact handle : alias }
+        self._aliases = {}
+
+        # { contact handle : alias before the queued changes }, in the order
+        # given by self._queued_aliases_order
+        self._queued_aliases = {}
+        self._queued_aliases_order = []
+        self._aliases_changed_id = None
+
+        self._implement_contact_attributes(CONN_INTERFACE_ALIASING,
+            self._get_alias_attributes)
+
+    def _get_alias_attributes(self, handles):
+        ret = {}
+        for handle, alias in self.GetAliases(handles).iteritems():
+            ret[handle] = {'alias': dbus.String(alias)}
+        return ret
+
+    def _get_alias(self, handle):
+        alias = self._aliases.get(handle)
+        if alias is None:
+            alias = self._handles[HANDLE_TYPE_CONTACT, handle].get_name()
+        return alias
+
+    @dbus.service.method(CONN_INTERFACE_ALIASING, in_signature='au',
+                         out_signature='as')
+    def RequestAliases(self, contacts):
+        self.check_connected()
+        self.check_handles(HANDLE_TYPE_CONTACT, contacts)
+        return dbus.Array([self._get_alias(handle) for handle in contacts],
+            signature='s')
+
+    @dbus.service.method(CONN_INTERFACE_ALIASING, in_signature='au',
+                         out_signature='a{us}')
+    def GetAliases(self, contacts):
+        self.check_connected()
+        self.check_handles(HANDLE_TYPE_CONTACT, contacts)
+        return dbus.Dictionary([(handle, self._get_alias(handle))
+            for handle in contacts], signature='us')
+
+    def set_aliases(self, aliases):
+        """
+        Record the aliases in the given { contact handle : alias } dict or
+        (contact handle, alias) list without signalling them, for instance
+        when the roster is received on connection.
+        """
+        if isinstance(aliases, dict):
+            aliases = aliases.items()
+        self._update_aliases(aliases)
+
+    def _update_aliases(self, aliases):
+        table = self._aliases
+        handles = []
+        for handle, alias in aliases:
+            table[handle] = alias
+            handles.append(handle)
+        self._contact_attributes_changed(CONN_INTERFACE_ALIASING, handles)
+
+    def queue_aliases_changed(self, aliases):
+        """
+        Record the given (contact handle, alias) pairs like AliasesChanged,
+        but emit the signal from an idle callback. The changes queued during
+        one main loop iteration are signalled together, keeping the latest
+        alias of each contact, and aliases which end up as they were are not
+        signalled at all.
+        """
+        queued = self._queued_aliases
+        for handle, alias in aliases:
+            if handle not in queued:
+                queued[handle] = self._aliases.get(handle)
+                self._queued_aliases_order.append(handle)
+        self._update_aliases(aliases)
+
+        if queued and self._aliases_changed_id is None:
+            self._aliases_changed_id = \
+                gobject.idle_add(self._aliases_changed_idle_cb)
+
+    def _aliases_changed_idle_cb(self):
+        self._aliases_changed_id = None
+        self.flush_aliases_changed()
+        return False
+
+    def flush_aliases_changed(self):
+        """
+        Emit AliasesChanged for the changes queued with
+        queue_aliases_changed() now.
+        """
+        if self._aliases_changed_id is not None:
+            gobject.source_remove(self._aliases_changed_id)
+            self._aliases_changed_id = None
+
+        queued = self._queued_aliases
+        order = self._queued_aliases_order
+        self._queued_aliases = {}
+        self._queued_aliases_order = []
+
+        aliases = []
+        for handle in order:
+            alias = self._aliases[handle]
+            if queued[handle] != alias:
+                aliases.append((handle, alias))
+
+        if aliases:
+            self.AliasesChanged(aliases)
+
+    @dbus.service.signal(CONN_INTERFACE_ALIASING, signature='a(us)')
+    def AliasesChanged(self, aliases):
+        self._update_aliases(aliases)
 
 
 from telepathy._generated.Connection_Interface_Avatars \
-        import ConnectionInterfaceAvatars
+        import ConnectionInterfaceAvatars as _ConnectionInterfaceAvatars
+
+class ConnectionInterfaceAvatars(_ConnectionInterfaceAvatars):
+    """
+    Keeps the current avatar token of each contact from AvatarUpdated and
+    AvatarRetrieved, and answers GetKnownAvatarTokens from them.
+
+    If _avatar_cache is set to an AvatarCache, the avatars signalled with
+    AvatarRetrieved are stored in it, and RequestAvatars emits
+    AvatarRetrieved straight from the cache for the contacts whose current
+    avatar is there; the other contacts are passed to _request_avatars(),
+    which subclasses implement to fetch them from the server. The cache is
+    read and written by a worker thread, so connection managers using it
+    must call gobject.threads_init().
+    """
+
+    def __init__(self):
+        _ConnectionInterfaceAvatars.__init__(self)
+        # { contact handle : avatar token }
+        self._avatar_tokens = {}
+        self._avatar_cache = None
+        # (function, args) to be called by the worker thread, created with
+        # the thread
+        self._avatar_jobs = None
+
+        self._implement_contact_attributes(CONN_INTERFACE_AVATARS,
+            self._get_avatar_attributes)
+
+    def _get_avatar_attributes(self, handles):
+        ret = {}
+        for handle, token in self.GetKnownAvatarTokens(handles).iteritems():
+            ret[handle] = {'token': dbus.String(token)}
+        return ret
+
+    @dbus.service.method(CONN_INTERFACE_AVATARS, in_signature='au',
+                         out_signature='a{us}')
+    def GetKnownAvatarTokens(self, contacts):
+        self.check_connected()
+        self.check_handles(HANDLE_TYPE_CONTACT, contacts)
+
+        ret = dbus.Dictionary(signature='us')
+        tokens = self._avatar_tokens
+        for handle in contacts:
+            if handle in tokens:
+                ret[handle] = tokens[handle]
+        return ret
+
+    @dbus.service.method(CONN_INTERFACE_AVATARS, in_signature='au',
+                         out_signature='')
+    def RequestAvatars(self, contacts):
+        self.check_connected()
+        self.check_handles(HANDLE_TYPE_CONTACT, contacts)
+
+        cache = self._avatar_cache
+        missing = []
+        for handle in contacts:
+            token = self._avatar_tokens.get(handle)
+            if token == '':
+                # the contact has no avatar
+                continue
+            if cache is not None and token is not None and token in cache:
+                self._queue_avatar_job(self._load_avatar, handle, token)
+            else:
+                missing.append(handle)
+
+        if missing:
+            self._request_avatars(missing)
+
+    def _request_avatars(self, contacts):
+        """
+        Fetch the avatars of the given contacts from the server, and emit
+        AvatarRetrieved for each of them which has one.
+        """
+        raise NotImplemented('avatars can not be requested')
+
+    def _queue_avatar_job(self, function, *args):
+        if self._avatar_jobs is None:
+            self._avatar_jobs = Queue.Queue()
+            thread = threading.Thread(target=self._avatar_worker,
+                args=(self._avatar_jobs,))
+            thread.setDaemon(True)
+            thread.start()
+        self._avatar_jobs.put((function, args))
+
+    def _avatar_worker(self, jobs):
+        while True:
+            function, args = jobs.get()
+            try:
+                function(*args)
+            except:
+                # keep the thread running for the next jobs; log from the
+                # main loop, as the Debug interface may emit a signal
+                gobject.idle_add(logger.error, 'avatar job %s failed:\n%s',
+                    function.__name__, traceback.format_exc())
+
+    def _load_avatar(self, handle, token):
+        # called in the worker thread
+        try:
+            avatar = self._avatar_cache.get(token)
+        except:
+            # fetch it from the server, as if it wasn't in the cache
+            gobject.idle_add(self._avatar_load_failed_cb, handle)
+            raise
+        if avatar is None:
+            # evicted since RequestAvatars looked
+            gobject.idle_add(self._avatar_load_failed_cb, handle)
+        else:
+            data, mime_type = avatar
+            gobject.idle_add(self._avatar_loaded_cb, handle, token, data,
+                mime_type)
+
+    def _avatar_loaded_cb(self, handle, token, data, mime_type):
+        self.AvatarRetrieved(handle, token, dbus.ByteArray(data), mime_type)
+        return False
+
+    def _avatar_load_failed_cb(self, handle):
+        self._request_avatars([handle])
+        return False
+
+    def _store_avatar(self, token, avatar, mime_type):
+        # called in the worker thread
+        if not isinstance(avatar, str):
+            avatar = ''.join([chr(byte) for byte in avatar])
+        try:
+            self._avatar_cache.set(token, avatar, str(mime_type))
+        except (IOError, OSError), e:
+            # from the main loop, as the Debug interface may emit a signal
+            gobject.idle_add(logger.warning, 'failed to cache avatar %s: %s',
+                token, e)
+
+    @dbus.service.signal(CONN_INTERFACE_AVATARS, signature='us')
+    def AvatarUpdated(self, contact, new_avatar_token):
+        self._avatar_tokens[contact] = new_avatar_token
+        self._contact_attributes_changed(CONN_INTERFACE_AVATARS, [contact])
+
+    @dbus.service.signal(CONN_INTERFACE_AVATARS, signature='usays')
+    def AvatarRetrieved(self, contact, token, avatar, type):
+        if self._avatar_tokens.get(contact) != token:
+            self._avatar_tokens[contact] = token
+            self._contact_attributes_changed(CONN_INTERFACE_AVATARS,
+                [contact])
+
+        cache = self._avatar_cache
+        if cache is not None and token not in cache:
+            self._queue_avatar_job(self._store_avatar, token, avatar, type)
 
 
 from telepathy._generated.Connection_Interface_Capabilities \
@@ -332,29 +752,127 @@ class ConnectionInterfaceCapabilities(_ConnectionInterfaceCapabilities):
         # { contact handle : { str channel type : [int, int] }}
         # the first int is the generic caps, the second is the type-specific
         self._caps = {}
+        # { str channel type : set(contact handles) }
+        self._caps_by_type = {}
+
+        # { (contact handle, channel type) : (gen old, spec old) } waiting
+        # to be signalled, in the order given by self._queued_caps_order
+        self._queued_caps = {}
+        self._queued_caps_order = []
+        self._caps_changed_id = None
+
+        self._implement_contact_attributes(CONN_INTERFACE_CAPABILITIES,
+            self._get_caps_attributes)
+
+    def _get_caps_attributes(self, handles):
+        ret = {}
+        for handle, ctype, generic, specific in self.GetCapabilities(handles):
+            if handle not in ret:
+                ret[handle] = {'caps': dbus.Array([], signature='(usuu)')}
+            ret[handle]['caps'].append((handle, ctype, generic, specific))
+        return ret
+
+    def _update_capabilities(self, caps):
+        for handle, ctype, gen_old, gen_new, spec_old, spec_new in caps:
+            if gen_new or spec_new:
+                self._caps.setdefault(handle, {})[ctype] = [gen_new, spec_new]
+                self._caps_by_type.setdefault(ctype, set()).add(handle)
+            else:
+                # the channel type is not supported any more
+                types = self._caps.get(handle)
+                if types is not None:
+                    types.pop(ctype, None)
+                    if not types:
+                        del self._caps[handle]
+                handles = self._caps_by_type.get(ctype)
+                if handles is not None:
+                    handles.discard(handle)
+                    if not handles:
+                        del self._caps_by_type[ctype]
+
+        self._contact_attributes_changed(CONN_INTERFACE_CAPABILITIES,
+            [c[0] for c in caps])
+
+    def get_capable_contacts(self, ctype):
+        """
+        Return the set of contact handle numbers having any capabilities
+        for the given channel type.
+        """
+        return frozenset(self._caps_by_type.get(ctype, ()))
 
     @dbus.service.method(CONN_INTERFACE_CAPABILITIES, in_signature='au', out_signature='a(usuu)')
     def GetCapabilities(self, handles):
+        self.check_handles(HANDLE_TYPE_CONTACT,
+            [handle for handle in handles if handle != 0])
+
         ret = []
-        handle_type = HANDLE_TYPE_CONTACT
+        caps = self._caps
         for handle in handles:
-            if (handle != 0 and (handle_type, handle) not in self._handles):
-                raise InvalidHandle
-            elif handle in self._caps:
-                types = self._caps[handle]
-                for ctype, specs in types.items():
-                    ret.append([handle, ctype, specs[0], specs[1]])
+            types = caps.get(handle)
+            if types:
+                for ctype, (generic, specific) in types.iteritems():
+                    ret.append((handle, ctype, generic, specific))
         return ret
 
+    def queue_capabilities_changed(self, caps):
+        """
+        Change capabilities like CapabilitiesChanged, but emit the signal
+        from an idle callback. The changes queued for each contact and
+        channel type during a main loop iteration are merged, and those
+        which cancel out are not signalled at all.
+        """
+        self._update_capabilities(caps)
+
+        queued = self._queued_caps
+        for handle, ctype, gen_old, gen_new, spec_old, spec_new in caps:
+            key = (handle, ctype)
+            if key not in queued:
+                queued[key] = (gen_old, spec_old)
+                self._queued_caps_order.append(key)
+
+        if self._caps_changed_id is None:
+            self._caps_changed_id = \
+                gobject.idle_add(self._caps_changed_idle_cb)
+
+    def _caps_changed_idle_cb(self):
+        self._caps_changed_id = None
+        self.flush_capabilities_changed()
+        return False
+
+    def flush_capabilities_changed(self):
+        """
+        Emit CapabilitiesChanged for the changes queued with
+        queue_capabilities_changed() now.
+        """
+        if self._caps_changed_id is not None:
+            gobject.source_remove(self._caps_changed_id)
+            self._caps_changed_id = None
+
+        queued = self._queued_caps
+        order = self._queued_caps_order
+        self._queued_caps = {}
+        self._queued_caps_order = []
+
+        # signal the capabilities the contacts have now, which a direct
+        # CapabilitiesChanged may have changed since they were queued
+        caps = []
+        for key in order:
+            gen_old, spec_old = queued[key]
+            gen_new, spec_new = self._caps.get(key[0], {}).get(key[1], (0, 0))
+            if gen_old != gen_new or spec_old != spec_new:
+                caps.append(key + (gen_old, gen_new, spec_old, spec_new))
+
+        if caps:
+            self.CapabilitiesChanged(caps)
+
     @dbus.service.signal(CONN_INTERFACE_CAPABILITIES, signature='a(usuuuu)')
     def CapabilitiesChanged(self, caps):
-        for handle, ctype, gen_old, gen_new, spec_old, spec_new in caps:
-            self._caps.setdefault(handle, {})[ctype] = [gen_new, spec_new]
+        self._update_capabilities(caps)
 
     @dbus.service.method(CONN_INTERFACE_CAPABILITIES,
                          in_signature='a(su)as', out_signature='a(su)')
     def AdvertiseCapabilities(self, add, remove):
-        my_caps = self._caps.setdefault(self._self_handle, {})
+        my_caps = self._caps.get(self._self_handle, {})
 
         changed = {}
         for ctype, spec_caps in add:
@@ -375,9 +893,10 @@ class ConnectionInterfaceCapabilities(_ConnectionInterfaceCapabilities):
                 caps.append((self._self_handle, ctype, gen_old, gen_new,
                             spec_old, spec_new))
 
-        self.CapabilitiesChanged(caps)
+        self.queue_capabilities_changed(caps)
 
         # return all my capabilities
+        my_caps = self._caps.get(self._self_handle, {})
         return [(ctype, caps[1]) for ctype, caps in my_caps.iteritems()]
 
 from telepathy._generated.Connection_Interface_Requests \
@@ -479,15 +998,14 @@ class ConnectionInterfaceRequests(
         if target_handle_type != HANDLE_TYPE_NONE:
             if target_handle == None:
                 # Turn TargetID into TargetHandle.
-                for handle in self._handles.itervalues():
-                    if handle.get_name() == target_id and handle.get_type() == target_handle_type:
-                        target_handle = handle.get_id()
-                if not target_handle:
+                handle = self._handles.lookup(target_handle_type,
+                    self.normalize_handle_name(target_handle_type, target_id))
+                if handle is None:
                     raise InvalidHandle('TargetID %s not valid for type %d' %
-                        target_id, target_handle_type)
+                        (target_id, target_handle_type))
 
                 altered_properties[CHANNEL_INTERFACE + '.TargetHandle'] = \
-                    target_handle
+                    handle.get_id()
             else:
                 # Check the supplied TargetHandle is valid
                 self.check_handle(target_handle_type, target_handle)
@@ -543,13 +1061,261 @@ class ConnectionInterfaceRequests(
 
         _success(yours, channel._object_path, props)
 
-        self.signal_new_channels([channel])
+        if yours:
+            self.signal_new_channels([channel])
 
 from telepathy._generated.Connection_Interface_Presence \
-        import ConnectionInterfacePresence
+        import ConnectionInterfacePresence as _ConnectionInterfacePresence
+
+class ConnectionInterfacePresence(_ConnectionInterfacePresence):
+    # how long, in milliseconds, to collect presence changes queued with
+    # queue_presence_update() before signalling them together; 0 means until
+    # the main loop is idle
+    _presence_update_interval = 0
+
+    def __init__(self):
+        _ConnectionInterfacePresence.__init__(self)
+        # { contact handle : (last activity time, { status : { argument :
+        #   value }}) }
+        self._presence = {}
+
+        # set(contact handles) whose presence is waiting to be signalled
+        self._queued_presence = set()
+        self._presence_update_id = None
+
+    @dbus.service.method(CONN_INTERFACE_PRESENCE, in_signature='au',
+                         out_signature='a{u(ua{sa{sv}})}')
+    def GetPresence(self, contacts):
+        self.check_connected()
+        self.check_handles(HANDLE_TYPE_CONTACT, contacts)
+
+        ret = dbus.Dictionary(signature='u(ua{sa{sv}})')
+        presence = self._presence
+        for handle in contacts:
+            if handle in presence:
+                ret[handle] = presence[handle]
+        return ret
+
+    def queue_presence_update(self, presence):
+        """
+        Record the given presences like PresenceUpdate, but emit the signal
+        later. The presences queued within _presence_update_interval
+        milliseconds are signalled together, only the latest one being kept
+        for each contact.
+        """
+        self._presence.update(presence)
+        self._queued_presence.update(presence.iterkeys())
+
+        if self._queued_presence and self._presence_update_id is None:
+            if self._presence_update_interval:
+                self._presence_update_id = gobject.timeout_add(
+                    self._presence_update_interval,
+                    self._presence_update_cb)
+            else:
+                self._presence_update_id = \
+                    gobject.idle_add(self._presence_update_cb)
+
+    def _presence_update_cb(self):
+        self._presence_update_id = None
+        self.flush_presence_update()
+        return False
+
+    def flush_presence_update(self):
+        """
+        Emit PresenceUpdate for the presences queued with
+        queue_presence_update() now.
+        """
+        if self._presence_update_id is not None:
+            gobject.source_remove(self._presence_update_id)
+            self._presence_update_id = None
+
+        queued = self._queued_presence
+        self._queued_presence = set()
+
+        # signal the presences the contacts have now, which a direct
+        # PresenceUpdate may have changed since they were queued
+        current = self._presence
+        presence = {}
+        for handle in queued:
+            presence[handle] = current[handle]
+
+        if presence:
+            self.PresenceUpdate(presence)
+
+    @dbus.service.signal(CONN_INTERFACE_PRESENCE,
+                         signature='a{u(ua{sa{sv}})}')
+    def PresenceUpdate(self, presence):
+        self._presence.update(presence)
+        # these presences don't need to be signalled again
+        self._queued_presence.difference_update(presence.iterkeys())
 
 from telepathy._generated.Connection_Interface_Simple_Presence \
-        import ConnectionInterfaceSimplePresence
+        import ConnectionInterfaceSimplePresence \
+        as _ConnectionInterfaceSimplePresence
+
+# the presence of contacts the connection has no information about
+_UNKNOWN_PRESENCE = (CONNECTION_PRESENCE_TYPE_UNKNOWN, 'unknown', '')
+
+class ConnectionInterfaceSimplePresence(_ConnectionInterfaceSimplePresence,
+                                        DBusProperties):
+    # how long, in milliseconds, to collect presence changes queued with
+    # queue_presences_changed() before signalling them together; 0 means
+    # until the main loop is idle
+    _presences_changed_interval = 0
+
+    def __init__(self):
+        _ConnectionInterfaceSimplePresence.__init__(self)
+        DBusProperties.__init__(self)
+        # { contact handle : (presence type, status, message) }
+        self._presences = {}
+        # { status : (presence type, may set on self, can have message) }
+        self._statuses = {}
+
+        # the same, for the presences waiting to be signalled
+        self._queued_presences = {}
+        self._presences_changed_id = None
+
+        self._implement_property_get(CONNECTION_INTERFACE_SIMPLE_PRESENCE, {
+            'Statuses': lambda: dbus.Dictionary(self._statuses,
+                signature='s(ubb)'),
+            })
+        self._implement_contact_attributes(
+            CONNECTION_INTERFACE_SIMPLE_PRESENCE,
+            self._get_presence_attributes)
+
+    def _get_presence_attributes(self, handles):
+        ret = {}
+        for handle, presence in self.GetPresences(handles).iteritems():
+            ret[handle] = {'presence': dbus.Struct(presence,
+                signature='uss')}
+        return ret
+
+    def _update_presences(self, presences):
+        self._presences.update(presences)
+        self._contact_attributes_changed(
+            CONNECTION_INTERFACE_SIMPLE_PRESENCE, presences.keys())
+
+    @dbus.service.method(CONNECTION_INTERFACE_SIMPLE_PRESENCE,
+                         in_signature='au', out_signature='a{u(uss)}')
+    def GetPresences(self, contacts):
+        self.check_connected()
+        self.check_handles(HANDLE_TYPE_CONTACT, contacts)
+
+        get = self._presences.get
+        return dbus.Dictionary([(handle, get(handle, _UNKNOWN_PRESENCE))
+            for handle in contacts], signature='u(uss)')
+
+    def queue_presences_changed(self, presences):
+        """
+        Record the given presences like PresencesChanged, but emit the
+        signal later. The presences queued within
+        _presences_changed_interval milliseconds are signalled together,
+        only the latest one being kept for each contact, and those which
+        end up as they were are not signalled at all.
+        """
+        queued = self._queued_presences
+        old = self._presences
+        for handle in presences:
+            if handle not in queued:
+                queued[handle] = old.get(handle, _UNKNOWN_PRESENCE)
+        self._update_presences(presences)
+
+        if queued and self._presences_changed_id is None:
+            if self._presences_changed_interval:
+                self._presences_changed_id = gobject.timeout_add(
+                    self._presences_changed_interval,
+                    self._presences_changed_cb)
+            else:
+                self._presences_changed_id = \
+                    gobject.idle_add(self._presences_changed_cb)
+
+    def _presences_changed_cb(self):
+        self._presences_changed_id = None
+        self.flush_presences_changed()
+        return False
+
+    def flush_presences_changed(self):
+        """
+        Emit PresencesChanged for the presences queued with
+        queue_presences_changed() now.
+        """
+        if self._presences_changed_id is not None:
+            gobject.source_remove(self._presences_changed_id)
+            self._presences_changed_id = None
+
+        queued = self._queued_presences
+        self._queued_presences = {}
+
+        presences = self._presences
+        changed = {}
+        for handle, old in queued.iteritems():
+            new = presences[handle]
+            if tuple(old) != tuple(new):
+                changed[handle] = new
+
+        if changed:
+            self.PresencesChanged(changed)
+
+    @dbus.service.signal(CONNECTION_INTERFACE_SIMPLE_PRESENCE,
+                         signature='a{u(uss)}')
+    def PresencesChanged(self, presence):
+        self._update_presences(presence)
 
 from telepathy._generated.Connection_Interface_Contacts \
-        import ConnectionInterfaceContacts
+        import ConnectionInterfaceContacts as _ConnectionInterfaceContacts
+
+class ConnectionInterfaceContacts(_ConnectionInterfaceContacts,
+                                  DBusProperties):
+    """
+    Implements GetContactAttributes using the contact attributes registered
+    by the other interfaces of the connection with
+    Connection._implement_contact_attributes().
+    """
+
+    def __init__(self):
+        _ConnectionInterfaceContacts.__init__(self)
+        DBusProperties.__init__(self)
+
+        if getattr(self, '_contact_attribute_providers', None) is None:
+            self._contact_attribute_providers = {}
+            self._contact_attribute_cache = {}
+
+        self._implement_property_get(CONNECTION_INTERFACE_CONTACTS,
+            {'ContactAttributeInterfaces': lambda: dbus.Array(
+                self._contact_attribute_providers.keys(), signature='s')})
+
+    @dbus.service.method(CONNECTION_INTERFACE_CONTACTS,
+        in_signature='auasb', out_signature='a{ua{sv}}',
+        sender_keyword='sender')
+    def GetContactAttributes(self, handles, interfaces, hold, sender):
+        self.check_connected()
+
+        interfaces = set(interfaces)
+        interfaces.discard(CONN_INTERFACE)
+        for iface in interfaces:
+            if iface not in self._contact_attribute_providers:
+                raise InvalidArgument('interface %s has no contact attributes'
+                    % iface)
+
+        # invalid handles are simply omitted from the result
+        valid = []
+        ret = dbus.Dictionary(signature='ua{sv}')
+        for handle in set(handles):
+            hand = self._handles.get((HANDLE_TYPE_CONTACT, handle))
+            if hand is None:
+                continue
+            if hold:
+                self.add_client_handle(hand, sender)
+            valid.append(handle)
+            ret[handle] = dbus.Dictionary(
+                {CONN_INTERFACE + '/contact-id': dbus.String(hand.get_name())},
+                signature='sv')
+
+        for iface in interfaces:
+            cache = self._get_contact_attributes(iface, valid)
+            for handle in valid:
+                attributes = ret[handle]
+                for name, value in cache[handle].iteritems():
+                    attributes[iface + '/' + name] = value
+
+        return ret
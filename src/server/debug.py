@@ -26,11 +26,15 @@ from telepathy.constants import (DEBUG_LEVEL_ERROR,
 from telepathy._generated.Debug import Debug as _Debug
 from telepathy.server.properties import DBusProperties
 
+import atexit
 import dbus.service
+import gobject
 import logging
 import sys
 import time
 
+from collections import deque
+
 LEVELS = {
         logging.ERROR:   DEBUG_LEVEL_ERROR,
         logging.FATAL:   DEBUG_LEVEL_CRITICAL,
@@ -41,13 +45,40 @@ LEVELS = {
 }
 
 DEBUG_MESSAGE_LIMIT = 800
+STDERR_QUEUE_LIMIT = 64 * 1024
+
+def _format_message(msg, args):
+    if not isinstance(msg, basestring):
+        msg = str(msg)
+    if args:
+        try:
+            msg = msg % args
+        except (TypeError, ValueError, KeyError):
+            pass
+    return msg
 
 class Debug(_Debug, DBusProperties, logging.Handler):
 
-    def __init__(self, conn_manager, root=''):
+    def __init__(self, conn_manager, root='', limit=DEBUG_MESSAGE_LIMIT,
+                 buffer_stderr=False):
+        """
+        Parameters:
+        conn_manager - the ConnectionManager to export the interface for
+        root - the name of the logger whose messages are collected
+        limit - the number of messages to keep for GetMessages
+        buffer_stderr - if True, output to stderr is queued and processed
+            from an idle callback (see StdErrWrapper)
+        """
+        if limit < 0:
+            raise ValueError('the message limit must not be negative')
+
         self.enabled = False
         self._interfaces = set()
-        self._messages = []
+        # (timestamp, name, level, format string, args), oldest first
+        self._messages = deque()
+        self._limit = limit
+        # { logger name : Telepathy debug domain }
+        self._record_names = {}
         object_path = '/org/freedesktop/Telepathy/debug'
 
         _Debug.__init__(self, conn_manager._name, object_path)
@@ -56,53 +87,133 @@ class Debug(_Debug, DBusProperties, logging.Handler):
 
         self._implement_property_get(DEBUG, {'Enabled': lambda: self.enabled})
         self._implement_property_set(DEBUG, {'Enabled': self._set_enabled})
+        self._cache_property_get(DEBUG)
         logging.getLogger(root).addHandler(self)
-        sys.stderr = StdErrWrapper(self, sys.stderr)
+        sys.stderr = StdErrWrapper(self, sys.stderr, buffered=buffer_stderr)
 
     def _set_enabled(self, value):
         self.enabled = value
+        self._properties_changed(DEBUG, ['Enabled'])
 
     def GetMessages(self):
-        return self._messages
-
-    def add_message(self, timestamp, name, level, msg):
-        if len(self._messages) >= DEBUG_MESSAGE_LIMIT:
-            self._messages.pop()
-        self._messages.append((timestamp, name, level, msg))
+        return [(timestamp, name, level, _format_message(msg, args))
+                for timestamp, name, level, msg, args in self._messages]
+
+    def add_message(self, timestamp, name, level, msg, args=None):
+        """
+        Add a message, dropping the oldest one if there are already as many
+        as the limit. If args is given, msg is a format string which is only
+        expanded when the message is retrieved or signalled.
+        """
         if self.enabled:
+            msg = _format_message(msg, args)
+            args = None
             self.NewDebugMessage(timestamp, name, level, msg)
+        self._messages.append((timestamp, name, level, msg, args))
+        if len(self._messages) > self._limit:
+            self._messages.popleft()
 
     # Handle logging module messages
 
     def emit(self, record):
         name = self.get_record_name(record)
         level = self.get_record_level(record)
-        self.add_message(record.created, name, level, record.msg)
+        self.add_message(record.created, name, level, record.msg, record.args)
 
     def get_record_level(self, record):
         return LEVELS[record.levelno]
 
     def get_record_name(self, record):
-        name = record.name
-        if name.contains("."):
-            domain, category = record.name.split('.', 1)
-            name = domain + "/" + category
+        name = self._record_names.get(record.name)
+        if name is None:
+            name = record.name
+            if "." in name:
+                domain, category = name.split('.', 1)
+                name = domain + "/" + category
+            self._record_names[record.name] = name
         return name
 
 # Wrapper around stderr so the exceptions are logged
 
 class StdErrWrapper(object):
-
-    def __init__(self, interface, stderr):
+    """
+    Copies everything written to stderr to the Debug interface, one message
+    per line.
+
+    In buffered mode, write() only queues the output; it is written to the
+    real stderr and split into debug messages from an idle callback, or
+    when flush() is called. If more than limit bytes are waiting, further
+    writes are dropped until the queue has been processed; the dropped
+    attribute counts them.
+    """
+
+    def __init__(self, interface, stderr, buffered=False,
+                 limit=STDERR_QUEUE_LIMIT):
         self._buffer = ""
         self._interface = interface
         self._stderr = stderr
+        self._buffered = buffered
+        self._limit = limit
+        # (timestamp, string) waiting to be processed, oldest first
+        self._queue = deque()
+        self._queued = 0
+        self._drain_id = None
+        self._dropped_since_drain = 0
+        self.dropped = 0
+
+        if buffered:
+            # don't lose the last traceback when the process exits
+            atexit.register(self.flush)
 
     def __getattr__(self, attr):
         return getattr(self._stderr, attr)
 
     def write(self, string):
-        self._stderr.write(string)
+        if not self._buffered:
+            self._stderr.write(string)
+            self._add_lines(time.time(), string)
+            return
+
+        if self._queued + len(string) > self._limit:
+            self.dropped += 1
+            self._dropped_since_drain += 1
+            return
+
+        self._queue.append((time.time(), string))
+        self._queued += len(string)
+        if self._drain_id is None:
+            self._drain_id = gobject.idle_add(self._drain_idle_cb)
+
+    def flush(self):
+        if self._drain_id is not None:
+            gobject.source_remove(self._drain_id)
+            self._drain_id = None
+        self._drain()
+        self._stderr.flush()
+
+    def _drain_idle_cb(self):
+        self._drain_id = None
+        self._drain()
+        return False
+
+    def _drain(self):
+        queue = self._queue
+        self._queue = deque()
+        self._queued = 0
+
+        if queue:
+            self._stderr.write(''.join([string for _, string in queue]))
+            for timestamp, string in queue:
+                self._add_lines(timestamp, string)
+
+        if self._dropped_since_drain:
+            note = '%d writes to stderr were dropped\n' % \
+                self._dropped_since_drain
+            self._dropped_since_drain = 0
+            self._stderr.write(note)
+            self._add_lines(time.time(), note)
+
+    def _add_lines(self, timestamp, string):
         if '\n' not in string:
             self._buffer += string
             return
@@ -112,6 +223,5 @@ class StdErrWrapper(object):
         self._buffer = lines[-1]
         del lines[-1]
 
-        timestamp = time.time()
         for line in lines:
             self._interface.add_message(timestamp, "stderr", DEBUG_LEVEL_ERROR, line)
@@ -17,11 +17,29 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+import weakref
+
 class Handle(object):
+    """
+    A handle of a given type, with its id and the name it refers to.
+
+    Handles are immutable and compare equal if they have the same type and
+    id. Subclasses may add their own attributes, and may still assign
+    _id, _type and _name themselves; they must not change them once the
+    handle is in use, as that would change its hash.
+    """
+
+    __slots__ = ('_id', '_type', '_name', '__weakref__')
+
     def __init__(self, id, handle_type, name):
-        self._id = id
-        self._type = handle_type
-        self._name = name
+        object.__setattr__(self, '_id', id)
+        object.__setattr__(self, '_type', handle_type)
+        object.__setattr__(self, '_name', name)
+
+    def __setattr__(self, attr, value):
+        if attr in Handle.__slots__ and type(self) is Handle:
+            raise AttributeError('handles are immutable')
+        object.__setattr__(self, attr, value)
 
     def get_id(self):
         return self._id
@@ -39,7 +57,198 @@ class Handle(object):
         return self._name
 
     def __eq__(self, other):
-        return (int(self) == int(other) and self.get_type() == other.get_type())
+        if not isinstance(other, Handle):
+            return NotImplemented
+        return self._id == other._id and self._type == other._type
 
     def __ne__(self, other):
-        return not self.__eq__(other)
+        if not isinstance(other, Handle):
+            return NotImplemented
+        return self._id != other._id or self._type != other._type
+
+    def __hash__(self):
+        return hash(self._id) ^ (self._type << 24)
+
+class _HandleRef(weakref.ref):
+    __slots__ = ('key', 'name')
+
+class HandleRepository(object):
+    """
+    Storage for the handles of a connection.
+
+    Behaves like a dict mapping (handle type, handle id) to Handle objects,
+    and additionally keeps a table of names for each handle type so that
+    lookup() does not have to scan every handle. Use intern_name() on
+    names of new handles so they share storage with this table.
+
+    Handles are held weakly, except for those held by clients with hold().
+    A handle keeps a count of the clients holding it; when this drops to
+    zero the repository's reference is only dropped by the next sweep(),
+    so that handles released and re-requested in quick succession are not
+    reallocated. Once nothing else references a handle it is removed from
+    both indexes, and removed_cb, if given, is called with its key.
+    """
+
+    def __init__(self, removed_cb=None):
+        # { (handle type, id) : _HandleRef }
+        self._by_id = {}
+        # { handle type : { name : _HandleRef } }
+        self._by_name = {}
+        # { (handle type, id) : [Handle, number of clients holding it] }
+        self._held = {}
+        # keys of held handles whose count has dropped to zero
+        self._unreferenced = set()
+        self._reclaimed = 0
+        self._removed_cb = removed_cb
+
+    def _collected(self, ref):
+        if self._by_id.get(ref.key) is ref:
+            del self._by_id[ref.key]
+            self._unindex(ref)
+            self._reclaimed += 1
+            if self._removed_cb is not None:
+                self._removed_cb(ref.key)
+
+    def _unindex(self, ref):
+        names = self._by_name[ref.key[0]]
+        if names.get(ref.name) is ref:
+            del names[ref.name]
+
+    def __setitem__(self, key, handle):
+        old = self._by_id.get(key)
+        if old is not None:
+            self._unindex(old)
+        ref = _HandleRef(handle, self._collected)
+        ref.key = key
+        ref.name = handle.get_name()
+        self._by_id[key] = ref
+        self._by_name.setdefault(key[0], {})[ref.name] = ref
+
+    def __getitem__(self, key):
+        handle = self._by_id[key]()
+        if handle is None:
+            raise KeyError(key)
+        return handle
+
+    def __delitem__(self, key):
+        ref = self._by_id.pop(key)
+        self._unindex(ref)
+        self._held.pop(key, None)
+        self._unreferenced.discard(key)
+        if self._removed_cb is not None:
+            self._removed_cb(key)
+
+    def __contains__(self, key):
+        ref = self._by_id.get(key)
+        return ref is not None and ref() is not None
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, key, default=None):
+        ref = self._by_id.get(key)
+        if ref is not None:
+            handle = ref()
+            if handle is not None:
+                return handle
+        return default
+
+    def keys(self):
+        return [key for key, ref in self._by_id.items() if ref() is not None]
+
+    def values(self):
+        return [handle for handle in [ref() for ref in self._by_id.values()]
+                if handle is not None]
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def items(self):
+        return [(key, handle)
+                for key, handle in [(key, ref())
+                                    for key, ref in self._by_id.items()]
+                if handle is not None]
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def lookup(self, handle_type, name):
+        """
+        Return the handle of the given type with the given name, or None
+        if there is no such handle.
+        """
+        names = self._by_name.get(handle_type)
+        if names is None:
+            return None
+        ref = names.get(name)
+        if ref is None:
+            return None
+        return ref()
+
+    def intern_name(self, handle_type, name):
+        """
+        Return name as a plain string, or the name of an existing handle of
+        the given type if it is equal. This drops the per-object overhead
+        of dbus.String and the like for names that are kept in handles.
+        """
+        names = self._by_name.get(handle_type)
+        if names is not None:
+            ref = names.get(name)
+            if ref is not None:
+                return ref.name
+        if isinstance(name, unicode):
+            return unicode(name)
+        return str(name)
+
+    def hold(self, key):
+        """
+        Add a client reference to the handle with the given key, keeping it
+        alive until a matching release().
+        """
+        entry = self._held.get(key)
+        if entry is None:
+            self._held[key] = [self[key], 1]
+        else:
+            entry[1] += 1
+            self._unreferenced.discard(key)
+
+    def release(self, key):
+        """
+        Drop a client reference to the handle with the given key. Returns
+        True if no clients hold the handle any more, in which case it will
+        be freed by the next sweep(), and False otherwise, including when
+        the handle has been deleted from the repository.
+        """
+        entry = self._held.get(key)
+        if entry is None:
+            return False
+        entry[1] -= 1
+        if entry[1] > 0:
+            return False
+        self._unreferenced.add(key)
+        return True
+
+    def sweep(self):
+        """
+        Drop the references to all handles that no client holds any more.
+        Returns the number of handles that were released.
+        """
+        unreferenced = self._unreferenced
+        self._unreferenced = set()
+        held = self._held
+        for key in unreferenced:
+            del held[key]
+        return len(unreferenced)
+
+    def get_statistics(self):
+        """
+        Return a dict of counters: 'live' is the number of handles in the
+        repository, 'held' the number held by at least one client (or
+        waiting for a sweep) and 'reclaimed' the number freed so far.
+        """
+        return {'live': len(self._by_id),
+                'held': len(self._held),
+                'reclaimed': self._reclaimed}
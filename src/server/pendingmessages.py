@@ -0,0 +1,264 @@
+# telepathy-python - Base classes defining the interfaces of the Telepathy framework
+#
+# Copyright (C) 2010 Collabora Limited
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import bisect
+import gobject
+import mmap
+import struct
+import tempfile
+
+class _Segment(object):
+    """
+    An append-only temporary file of message texts, read back through a
+    read-only memory map.
+    """
+
+    def __init__(self, directory=None):
+        self._file = tempfile.TemporaryFile(prefix='telepathy-pending-',
+                                            dir=directory)
+        self._size = 0
+        self._map = None
+
+    def append(self, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        offset = self._size
+        self._file.write(struct.pack('!I', len(text)) + text)
+        self._size += 4 + len(text)
+        return offset
+
+    def read(self, offset):
+        if self._map is None or len(self._map) < self._size:
+            self._file.flush()
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._file.fileno(), self._size,
+                                  access=mmap.ACCESS_READ)
+        (length,) = struct.unpack('!I', self._map[offset:offset + 4])
+        return self._map[offset + 4:offset + 4 + length].decode('utf-8')
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+class PendingMessageQueue(object):
+    """
+    The messages received on a text channel which have not been acknowledged
+    yet, kept in (timestamp, id) order.
+
+    Each message is stored as a single (timestamp, id, sender, type, flags,
+    text) tuple. Acknowledged messages are removed from the id index
+    straight away and from the ordered list lazily, so acknowledging k
+    messages costs O(k) and listing the oldest k messages is O(k) too.
+
+    If spill_threshold is given, only that many message texts are kept in
+    memory; the texts of further messages are appended to a temporary file
+    in spill_dir (by default the system temporary directory) and read back
+    through mmap when the messages are listed. The file is rewritten
+    without the acknowledged texts from an idle callback once they make up
+    most of it, and deleted when it holds none that are still pending.
+
+    For compatibility with code which used a plain dict, the queue can also
+    be used as a mapping from message id to (timestamp, sender, type,
+    flags, text).
+    """
+
+    def __init__(self, spill_threshold=None, spill_dir=None):
+        # (timestamp, id, sender, type, flags, text), including messages
+        # which have been acknowledged since the last compaction. For
+        # messages whose text is in the segment file, text is its offset.
+        self._messages = []
+        # { id : entry in self._messages }
+        self._by_id = {}
+        self._dead = 0
+
+        self._spill_threshold = spill_threshold
+        self._spill_dir = spill_dir
+        self._in_memory = 0
+        self._segment = None
+        self._spilled = 0
+        self._spilled_dead = 0
+        self._compact_segment_id = None
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __contains__(self, id):
+        return id in self._by_id
+
+    def __getitem__(self, id):
+        timestamp, _, sender, type, flags, text = self._by_id[id]
+        return (timestamp, sender, type, flags, self._text(text))
+
+    def __setitem__(self, id, message):
+        timestamp, sender, type, flags, text = message
+        self.add(id, timestamp, sender, type, flags, text)
+
+    def __delitem__(self, id):
+        self.acknowledge([id])
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [entry[1] for entry in self._live()]
+
+    def add(self, id, timestamp, sender, type, flags, text):
+        """Add a message to the queue, replacing any message with this id."""
+        if id in self._by_id:
+            self.acknowledge([id])
+
+        if self._spill_threshold is not None and \
+                self._in_memory >= self._spill_threshold:
+            if self._segment is None:
+                self._segment = _Segment(self._spill_dir)
+            text = self._segment.append(text)
+            self._spilled += 1
+        else:
+            self._in_memory += 1
+
+        entry = (timestamp, id, sender, type, flags, text)
+        messages = self._messages
+        if not messages or messages[-1][:2] < entry[:2]:
+            # messages almost always arrive in order
+            messages.append(entry)
+        else:
+            bisect.insort(messages, entry)
+        self._by_id[id] = entry
+
+    def acknowledge(self, ids):
+        """
+        Remove the messages with the given ids. If any id is not in the
+        queue, KeyError is raised and no message is removed.
+        """
+        by_id = self._by_id
+        removed = []
+        for id in ids:
+            entry = by_id.pop(id, None)
+            if entry is None:
+                for entry in removed:
+                    by_id[entry[1]] = entry
+                raise KeyError(id)
+            removed.append(entry)
+
+        for entry in removed:
+            if isinstance(entry[5], basestring):
+                self._in_memory -= 1
+            else:
+                self._spilled -= 1
+                self._spilled_dead += 1
+
+        self._dead += len(removed)
+        self._compact()
+        self._compact_spilled()
+
+    def list(self, count=None):
+        """
+        Return the oldest count messages (or all of them) as (id, timestamp,
+        sender, type, flags, text) tuples.
+        """
+        ret = []
+        if count is None:
+            count = len(self._by_id)
+        if count <= 0:
+            return ret
+        for timestamp, id, sender, type, flags, text in self._live():
+            ret.append((id, timestamp, sender, type, flags, self._text(text)))
+            if len(ret) == count:
+                break
+        return ret
+
+    def clear(self):
+        """Remove all the messages."""
+        self._messages = []
+        self._by_id = {}
+        self._dead = 0
+        self._in_memory = 0
+        self._spilled = 0
+        self._compact_spilled()
+
+    def _text(self, text):
+        if isinstance(text, basestring):
+            return text
+        return self._segment.read(text)
+
+    def _live(self):
+        by_id = self._by_id
+        for entry in self._messages:
+            if by_id.get(entry[1]) is entry:
+                yield entry
+
+    def _compact(self):
+        messages = self._messages
+        by_id = self._by_id
+
+        # usually the oldest messages are acknowledged first
+        head = 0
+        while head < len(messages) and by_id.get(messages[head][1]) is not \
+                messages[head]:
+            head += 1
+        if head:
+            del messages[:head]
+            self._dead -= head
+
+        if self._dead > len(by_id):
+            self._messages = list(self._live())
+            self._dead = 0
+
+    def _compact_spilled(self):
+        if self._segment is None:
+            return
+
+        if self._spilled == 0:
+            # nothing pending is on disk any more
+            if self._compact_segment_id is not None:
+                gobject.source_remove(self._compact_segment_id)
+                self._compact_segment_id = None
+            self._segment.close()
+            self._segment = None
+            self._spilled_dead = 0
+        elif self._spilled_dead > self._spilled and \
+                self._compact_segment_id is None:
+            self._compact_segment_id = \
+                gobject.idle_add(self._compact_segment_idle_cb)
+
+    def _compact_segment_idle_cb(self):
+        self._compact_segment_id = None
+        if self._segment is None:
+            return False
+
+        old = self._segment
+        new = _Segment(self._spill_dir)
+        messages = []
+        by_id = {}
+        for entry in self._live():
+            text = entry[5]
+            if not isinstance(text, basestring):
+                entry = entry[:5] + (new.append(old.read(text)),)
+            messages.append(entry)
+            by_id[entry[1]] = entry
+
+        old.close()
+        self._segment = new
+        self._messages = messages
+        self._by_id = by_id
+        self._dead = 0
+        self._spilled_dead = 0
+        return False
@@ -36,17 +36,64 @@ class DBusProperties(dbus.service.Interface):
         if not getattr(self, '_prop_getters', None):
             self._prop_getters = {}
             self._prop_setters = {}
+            # interfaces whose GetAll results may be cached, because every
+            # change to their properties is notified with
+            # _properties_changed()
+            self._prop_cached = set()
+            # { interface : dbus.Dictionary of all its properties }
+            self._prop_cache = {}
 
     def _implement_property_get(self, iface, dict):
         self._prop_getters.setdefault(iface, {}).update(dict)
+        self._prop_cache.pop(iface, None)
 
     def _implement_property_set(self, iface, dict):
         self._prop_setters.setdefault(iface, {}).update(dict)
 
+    def _cache_property_get(self, iface):
+        """
+        Cache the values of all the properties of iface after the first
+        Get or GetAll call. The implementation must then call
+        _properties_changed() whenever one of them changes.
+        """
+        self._prop_cached.add(iface)
+
+    def _properties_changed(self, iface, changed=(), invalidated=()):
+        """
+        Notify that properties of iface have changed, dropping any cached
+        values and emitting PropertiesChanged. The new values of the
+        properties named in changed are included in the signal; those
+        named in invalidated are only listed.
+        """
+        self._prop_cache.pop(iface, None)
+
+        getters = self._prop_getters[iface]
+        values = dbus.Dictionary(signature='sv')
+        for name in changed:
+            values[name] = getters[name]()
+
+        self.PropertiesChanged(iface, values,
+            dbus.Array(invalidated, signature='s'))
+
+    def _get_all_properties(self, iface):
+        props = self._prop_cache.get(iface)
+        if props is not None:
+            return props
+
+        props = dbus.Dictionary(signature='sv')
+        for k, v in self._prop_getters[iface].items():
+            props[k] = v()
+
+        if iface in self._prop_cached:
+            self._prop_cache[iface] = props
+        return props
+
     @dbus.service.method(dbus_interface=dbus.PROPERTIES_IFACE, in_signature='ss', out_signature='v')
     def Get(self, interface_name, property_name):
         if interface_name in self._prop_getters \
             and property_name in self._prop_getters[interface_name]:
+                if interface_name in self._prop_cached:
+                    return self._get_all_properties(interface_name)[property_name]
                 return self._prop_getters[interface_name][property_name]()
         else:
             raise telepathy.errors.InvalidArgument()
@@ -56,15 +103,18 @@ class DBusProperties(dbus.service.Interface):
         if interface_name in self._prop_setters \
             and property_name in self._prop_setters[interface_name]:
                 self._prop_setters[interface_name][property_name](value)
+                self._prop_cache.pop(interface_name, None)
         else:
             raise telepathy.errors.PermissionDenied()
 
     @dbus.service.method(dbus_interface=dbus.PROPERTIES_IFACE, in_signature='s', out_signature='a{sv}')
     def GetAll(self, interface_name):
         if interface_name in self._prop_getters:
-            r = {}
-            for k, v in self._prop_getters[interface_name].items():
-                r[k] = v()
-            return r
+            return self._get_all_properties(interface_name)
         else:
             raise telepathy.errors.InvalidArgument()
+
+    @dbus.service.signal(dbus_interface=dbus.PROPERTIES_IFACE, signature='sa{sv}as')
+    def PropertiesChanged(self, interface_name, changed_properties,
+            invalidated_properties):
+        pass
@@ -0,0 +1,1088 @@
+# telepathy-python - Base classes defining the interfaces of the Telepathy framework
+#
+# Copyright (C) 2010 Collabora Limited
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import array
+import errno
+import logging
+import os
+import Queue
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+
+from collections import deque
+
+import dbus
+import gobject
+
+from telepathy.constants import (FILE_HASH_TYPE_MD5,
+                                 FILE_HASH_TYPE_SHA1,
+                                 FILE_HASH_TYPE_SHA256,
+                                 SOCKET_ACCESS_CONTROL_LOCALHOST,
+                                 SOCKET_ADDRESS_TYPE_IPV4,
+                                 SOCKET_ADDRESS_TYPE_IPV6,
+                                 SOCKET_ADDRESS_TYPE_UNIX)
+from telepathy.errors import NotAvailable, NotImplemented
+
+try:
+    import hashlib
+    _HASHES = {
+        FILE_HASH_TYPE_MD5: hashlib.md5,
+        FILE_HASH_TYPE_SHA1: hashlib.sha1,
+        FILE_HASH_TYPE_SHA256: hashlib.sha256,
+        }
+    _sha1 = hashlib.sha1
+except ImportError:
+    # Python 2.4, which has no SHA-256
+    import md5
+    import sha
+    _HASHES = {
+        FILE_HASH_TYPE_MD5: md5.new,
+        FILE_HASH_TYPE_SHA1: sha.new,
+        }
+    _sha1 = sha.new
+
+logger = logging.getLogger('telepathy.server.transfer')
+
+# socket.recv_into is new in Python 2.5
+_HAVE_RECV_INTO = hasattr(socket.socket, 'recv_into')
+
+# 256 KiB
+DEFAULT_CHUNK_SIZE = 256 * 1024
+
+# how much is read from a socket at once
+RELAY_READ_SIZE = 64 * 1024
+# stop reading from a side once this much of its data is waiting to be
+# written to the other side, and start again when it is down to the low
+# watermark
+RELAY_HIGH_WATERMARK = 1024 * 1024
+RELAY_LOW_WATERMARK = 256 * 1024
+
+# the largest frame of D-Bus messages a DBusTubeMultiplexer sends over the
+# protocol at once, and how many milliseconds it waits for more messages
+# before sending a frame which is not full
+DBUS_TUBE_MAX_FRAME_SIZE = 64 * 1024
+DBUS_TUBE_FRAME_LATENCY = 10
+
+# what StreamPump does after writing a chunk
+_MORE, _BLOCKED, _DONE = range(3)
+
+# the largest D-Bus message the specification allows, 128 MiB
+_DBUS_MAXIMUM_MESSAGE_LENGTH = 128 * 1024 * 1024
+
+# D-Bus header fields used by DBusTubeMultiplexer
+_DBUS_HEADER_FIELD_DESTINATION = 6
+_DBUS_HEADER_FIELD_SENDER = 7
+
+# sizes of the fixed-length D-Bus types
+_DBUS_FIXED_SIZES = {'y': 1, 'b': 4, 'n': 2, 'q': 2, 'i': 4, 'u': 4,
+                     'x': 8, 't': 8, 'd': 8, 'h': 4}
+
+if hasattr(socket, 'SO_PEERCRED'):
+    _SO_PEERCRED = socket.SO_PEERCRED
+elif sys.platform.startswith('linux'):
+    _SO_PEERCRED = 17
+else:
+    _SO_PEERCRED = None
+
+def _would_block(e):
+    return e.args and e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                    errno.EINTR)
+
+class SocketListener(object):
+    """
+    A socket which clients of a channel connect to, of one of the
+    Socket_Address_Types, using the Localhost access control.
+
+    The D-Bus representation of its address, as returned by methods like
+    AcceptFile, is in the address attribute.
+    """
+
+    def __init__(self, address_type, access_control, access_control_param):
+        if access_control != SOCKET_ACCESS_CONTROL_LOCALHOST:
+            raise NotImplemented('access control %d is not supported'
+                % access_control)
+
+        self._directory = None
+        self._watch_id = None
+        try:
+            if address_type == SOCKET_ADDRESS_TYPE_UNIX:
+                self._directory = tempfile.mkdtemp(prefix='telepathy-')
+                path = os.path.join(self._directory, 'socket')
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.bind(path)
+                self.address = dbus.ByteArray(path)
+            elif address_type == SOCKET_ADDRESS_TYPE_IPV4:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.bind(('127.0.0.1', 0))
+                host, port = sock.getsockname()
+                self.address = dbus.Struct((host, dbus.UInt16(port)),
+                    signature='sq')
+            elif address_type == SOCKET_ADDRESS_TYPE_IPV6:
+                sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+                sock.bind(('::1', 0))
+                host, port = sock.getsockname()[:2]
+                self.address = dbus.Struct((host, dbus.UInt16(port)),
+                    signature='sq')
+            else:
+                raise NotImplemented('address type %d is not supported'
+                    % address_type)
+
+            sock.listen(5)
+            sock.setblocking(False)
+        except (socket.error, OSError), e:
+            self._remove_directory()
+            raise NotAvailable('failed to create socket: %s' % e)
+
+        self._socket = sock
+
+    def accept(self, callback):
+        """
+        Call callback from the main loop with each connection made to the
+        socket, as a non-blocking socket object, until close() is called.
+        """
+        if self._watch_id is None:
+            self._watch_id = gobject.io_add_watch(self._socket,
+                gobject.IO_IN, self._accept_cb, callback)
+
+    def _accept_cb(self, source, condition, callback):
+        try:
+            conn, address = self._socket.accept()
+        except socket.error, e:
+            if not _would_block(e):
+                logger.warning('failed to accept connection: %s', e)
+            return True
+
+        conn.setblocking(False)
+        callback(conn)
+        return True
+
+    def close(self):
+        """Stop listening, and remove the socket file if there is one."""
+        if self._watch_id is not None:
+            gobject.source_remove(self._watch_id)
+            self._watch_id = None
+        self._socket.close()
+        self._remove_directory()
+
+    def _remove_directory(self):
+        if self._directory is not None:
+            shutil.rmtree(self._directory, True)
+            self._directory = None
+
+class StreamPump(object):
+    """
+    Copies data from source to sink from the main loop. Either can be a
+    non-blocking socket or a file object.
+
+    A single buffer of chunk_size bytes is reused for the whole stream, and
+    the data is passed to the sink as buffer objects over it, so it is not
+    copied in Python (except when reading from a socket with Python 2.4,
+    which has no socket.recv_into). As long as the sink accepts the data as fast as it is
+    read, the pump only waits for the source.
+
+    Once count bytes have been copied (or at the end of the source if count
+    is None), done_cb(None, None) is called. If reading fails, or the source
+    ends before count bytes, it is called with the error as its first
+    argument instead; if writing fails, with the error as its second
+    argument. progress_cb is called with the number of bytes copied so far
+    each time some are written, and data_cb with a buffer over the bytes
+    themselves, which is only valid during the call.
+    """
+
+    def __init__(self, source, sink, count=None, progress_cb=None,
+                 done_cb=None, chunk_size=DEFAULT_CHUNK_SIZE, data_cb=None):
+        self._source = source
+        self._sink = sink
+        self._count = count
+        self._progress_cb = progress_cb
+        self._done_cb = done_cb
+        self._data_cb = data_cb
+
+        if count is not None and count < chunk_size:
+            chunk_size = max(count, 1)
+        self._buffer = array.array('c', '\0' * chunk_size)
+        # the part of the buffer still to be written
+        self._start = 0
+        self._end = 0
+
+        self._read_id = None
+        self._write_id = None
+        self.transferred = 0
+
+    def start(self):
+        """Start copying."""
+        if self._count == 0:
+            self._finish(None, None)
+        elif self._read_id is None and self._write_id is None:
+            self._read_id = gobject.io_add_watch(self._source,
+                gobject.IO_IN | gobject.IO_HUP | gobject.IO_ERR,
+                self._read_cb)
+
+    def stop(self):
+        """Stop copying, without calling done_cb."""
+        if self._read_id is not None:
+            gobject.source_remove(self._read_id)
+            self._read_id = None
+        if self._write_id is not None:
+            gobject.source_remove(self._write_id)
+            self._write_id = None
+
+    def _read(self):
+        buf = self._buffer
+        wanted = len(buf)
+        if self._count is not None:
+            wanted = min(wanted, self._count - self.transferred)
+
+        if isinstance(self._source, socket.socket):
+            if _HAVE_RECV_INTO:
+                return self._source.recv_into(buf, wanted)
+            data = self._source.recv(wanted)
+            buf[:len(data)] = array.array('c', data)
+            return len(data)
+
+        if wanted < len(buf):
+            # only happens for the last chunk of a file
+            buf = self._buffer = array.array('c', '\0' * wanted)
+        return self._source.readinto(buf)
+
+    def _write(self):
+        # returns True once the buffer has been written entirely
+        while self._start < self._end:
+            data = buffer(self._buffer, self._start, self._end - self._start)
+            if isinstance(self._sink, socket.socket):
+                try:
+                    sent = self._sink.send(data)
+                except socket.error, e:
+                    if _would_block(e):
+                        return False
+                    raise
+            else:
+                self._sink.write(data)
+                sent = len(data)
+
+            if self._data_cb is not None:
+                self._data_cb(buffer(self._buffer, self._start, sent))
+            self._start += sent
+            self.transferred += sent
+            if self._progress_cb is not None:
+                self._progress_cb(self.transferred)
+        return True
+
+    def _read_cb(self, source, condition):
+        try:
+            n = self._read()
+        except (socket.error, IOError, OSError), e:
+            if _would_block(e):
+                return True
+            self._read_id = None
+            self._finish(e, None)
+            return False
+
+        if n == 0:
+            self._read_id = None
+            if self._count is not None:
+                self._finish(EOFError('stream ended after %d of %d bytes'
+                    % (self.transferred, self._count)), None)
+            else:
+                self._finish(None, None)
+            return False
+
+        self._start = 0
+        self._end = n
+        result = self._write_buffer()
+        if result == _MORE:
+            return True
+
+        self._read_id = None
+        if result == _BLOCKED:
+            # wait until the sink can take the rest
+            self._write_id = gobject.io_add_watch(self._sink,
+                gobject.IO_OUT | gobject.IO_HUP | gobject.IO_ERR,
+                self._write_cb)
+        return False
+
+    def _write_cb(self, sink, condition):
+        result = self._write_buffer()
+        if result == _BLOCKED:
+            return True
+
+        self._write_id = None
+        if result == _MORE:
+            self._read_id = gobject.io_add_watch(self._source,
+                gobject.IO_IN | gobject.IO_HUP | gobject.IO_ERR,
+                self._read_cb)
+        return False
+
+    def _write_buffer(self):
+        try:
+            written = self._write()
+        except (socket.error, IOError, OSError), e:
+            self._finish(None, e)
+            return _DONE
+
+        if not written:
+            return _BLOCKED
+        if self._count is not None and self.transferred >= self._count:
+            self._finish(None, None)
+            return _DONE
+        return _MORE
+
+    def _finish(self, source_error, sink_error):
+        self._buffer = None
+        if not isinstance(self._sink, socket.socket):
+            try:
+                self._sink.flush()
+            except (IOError, OSError), e:
+                if sink_error is None and source_error is None:
+                    sink_error = e
+        if self._done_cb is not None:
+            self._done_cb(source_error, sink_error)
+
+class StreamHasher(object):
+    """
+    Computes the hash of a stream, of one of the File_Hash_Types, in a
+    worker thread so that hashing large files does not hold up the main
+    loop.
+
+    The data passed to update() is copied and queued for the worker. If
+    prefix_path is given, the first prefix_length bytes of that file are
+    hashed before it, which is how the hash of a resumed transfer covers the
+    whole file. Once finish() has been called and everything is hashed,
+    done_cb is called from the main loop with the hexadecimal digest, or
+    with None if the prefix could not be read.
+    """
+
+    def __init__(self, hash_type, done_cb, prefix_path=None,
+                 prefix_length=0):
+        factory = _HASHES.get(hash_type)
+        if factory is None:
+            raise NotImplemented('hash type %d is not supported' % hash_type)
+
+        self._hash = factory()
+        self._done_cb = done_cb
+        self._cancelled = False
+        self._queue = Queue.Queue()
+        if prefix_path is not None and prefix_length:
+            self._queue.put((prefix_path, prefix_length))
+
+        thread = threading.Thread(target=self._run)
+        thread.setDaemon(True)
+        thread.start()
+
+    def update(self, data):
+        """Queue data to be hashed."""
+        self._queue.put(str(data))
+
+    def finish(self):
+        """Call done_cb once all the queued data is hashed."""
+        self._queue.put(None)
+
+    def cancel(self):
+        """Stop hashing, without calling done_cb."""
+        self._cancelled = True
+        self._queue.put(None)
+
+    def _run(self):
+        # called in the worker thread
+        digest = None
+        try:
+            while not self._cancelled:
+                item = self._queue.get()
+                if item is None:
+                    digest = self._hash.hexdigest()
+                    break
+                if isinstance(item, tuple):
+                    self._hash_prefix(*item)
+                else:
+                    self._hash.update(item)
+        except (IOError, OSError), e:
+            # from the main loop, as the Debug interface may emit a signal
+            gobject.idle_add(logger.warning,
+                'failed to hash the start of the file: %s', e)
+
+        if not self._cancelled:
+            gobject.idle_add(self._done_idle_cb, digest)
+
+    def _hash_prefix(self, path, length):
+        f = open(path, 'rb')
+        try:
+            while length > 0:
+                data = f.read(min(length, DEFAULT_CHUNK_SIZE))
+                if not data:
+                    raise IOError('%s is shorter than %d bytes'
+                        % (path, length))
+                self._hash.update(data)
+                length -= len(data)
+        finally:
+            f.close()
+
+    def _done_idle_cb(self, digest):
+        if not self._cancelled:
+            self._done_cb(digest)
+        return False
+
+class TransferStateStore(object):
+    """
+    Remembers how far interrupted file transfers got, so that they can be
+    resumed rather than started again.
+
+    Transfers are identified by a key, a tuple of strings and numbers such
+    as the one returned by ChannelTypeFileTransfer._get_transfer_key(). The
+    offset reached by each is written to a small file in directory, named
+    after the SHA-1 hash of the key.
+    """
+
+    def __init__(self, directory):
+        self._directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+
+    def _path(self, key):
+        key = '\0'.join([unicode(part).encode('utf-8') for part in key])
+        return os.path.join(self._directory, _sha1(key).hexdigest())
+
+    def get_offset(self, key):
+        """
+        Return the offset the transfer with the given key got to, or 0 if it
+        is not known.
+        """
+        try:
+            f = open(self._path(key))
+            try:
+                return long(f.read().strip() or 0)
+            finally:
+                f.close()
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def set_offset(self, key, offset):
+        """Record the offset the transfer with the given key got to."""
+        fd, temp = tempfile.mkstemp(prefix='.transfer-', dir=self._directory)
+        try:
+            f = os.fdopen(fd, 'w')
+            try:
+                f.write('%d\n' % offset)
+            finally:
+                f.close()
+            os.rename(temp, self._path(key))
+        except (IOError, OSError), e:
+            logger.warning('failed to save transfer state: %s', e)
+            try:
+                os.unlink(temp)
+            except OSError:
+                pass
+
+    def forget(self, key):
+        """Forget the transfer with the given key, once it is over."""
+        try:
+            os.unlink(self._path(key))
+        except OSError:
+            pass
+
+class _RelayDirection(object):
+    """Copies one way between the sockets of a StreamRelay."""
+
+    def __init__(self, relay, source, sink, high_watermark, low_watermark):
+        self._relay = relay
+        self._source = source
+        self._sink = sink
+        self._high_watermark = high_watermark
+        self._low_watermark = low_watermark
+
+        # strings read from the source, the first one being written from
+        # self._offset
+        self._chunks = deque()
+        self._offset = 0
+        self.buffered = 0
+
+        self._read_id = None
+        self._write_id = None
+        self._eof = False
+        self.done = False
+
+    def start(self):
+        self._watch_source()
+
+    def stop(self):
+        if self._read_id is not None:
+            gobject.source_remove(self._read_id)
+            self._read_id = None
+        if self._write_id is not None:
+            gobject.source_remove(self._write_id)
+            self._write_id = None
+
+    def _watch_source(self):
+        if self._read_id is None and not self._eof:
+            self._read_id = gobject.io_add_watch(self._source,
+                gobject.IO_IN | gobject.IO_HUP | gobject.IO_ERR,
+                self._read_cb)
+
+    def _watch_sink(self):
+        if self._write_id is None:
+            self._write_id = gobject.io_add_watch(self._sink,
+                gobject.IO_OUT | gobject.IO_HUP | gobject.IO_ERR,
+                self._write_cb)
+
+    def _read_cb(self, source, condition):
+        try:
+            data = self._source.recv(RELAY_READ_SIZE)
+        except socket.error, e:
+            if _would_block(e):
+                return True
+            self._read_id = None
+            self._relay._failed(e)
+            return False
+
+        if not data:
+            self._read_id = None
+            self._eof = True
+            if not self._chunks:
+                self._finish()
+            return False
+
+        self._chunks.append(data)
+        self.buffered += len(data)
+        self._watch_sink()
+
+        if self.buffered >= self._high_watermark:
+            # wait for the sink to catch up
+            self._read_id = None
+            return False
+        return True
+
+    def _write_cb(self, sink, condition):
+        chunks = self._chunks
+        while chunks:
+            chunk = chunks[0]
+            try:
+                sent = self._sink.send(buffer(chunk, self._offset))
+            except socket.error, e:
+                if _would_block(e):
+                    break
+                self._write_id = None
+                self._relay._failed(e)
+                return False
+
+            self.buffered -= sent
+            self._offset += sent
+            if self._offset < len(chunk):
+                # the sink is full
+                break
+            chunks.popleft()
+            self._offset = 0
+
+        if self.buffered <= self._low_watermark:
+            self._watch_source()
+
+        if chunks:
+            return True
+
+        self._write_id = None
+        if self._eof:
+            self._finish()
+        return False
+
+    def _finish(self):
+        # pass the end of the stream on
+        try:
+            self._sink.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+        self.done = True
+        self._relay._direction_done()
+
+class StreamRelay(object):
+    """
+    Relays a connection through a stream tube between two non-blocking
+    sockets: local, connected to the tube application, and remote, the
+    protocol transport of the connection.
+
+    Both directions are copied from the main loop as the sockets become
+    readable and writable. Data is buffered until the other side accepts
+    it; once more than high_watermark bytes are waiting, reading from the
+    side sending them stops until the buffer is down to low_watermark, so
+    a fast sender cannot make the connection manager's memory grow without
+    bound.
+
+    When both sides have closed their end, or one of them fails, both
+    sockets are closed and closed_cb is called with None or the error.
+    """
+
+    def __init__(self, local, remote, closed_cb=None,
+                 high_watermark=RELAY_HIGH_WATERMARK,
+                 low_watermark=RELAY_LOW_WATERMARK):
+        self._local = local
+        self._remote = remote
+        self._closed_cb = closed_cb
+        self._directions = (
+            _RelayDirection(self, local, remote, high_watermark,
+                low_watermark),
+            _RelayDirection(self, remote, local, high_watermark,
+                low_watermark))
+        self._closed = False
+
+    def start(self):
+        """Start relaying."""
+        for direction in self._directions:
+            direction.start()
+
+    def get_buffered(self):
+        """
+        Return the numbers of bytes waiting to be written to the remote and
+        to the local side.
+        """
+        return (self._directions[0].buffered, self._directions[1].buffered)
+
+    def close(self):
+        """Stop relaying and close both sockets, without calling closed_cb."""
+        if self._closed:
+            return
+        self._closed = True
+        for direction in self._directions:
+            direction.stop()
+        self._local.close()
+        self._remote.close()
+
+    def _direction_done(self):
+        for direction in self._directions:
+            if not direction.done:
+                return
+        self.close()
+        if self._closed_cb is not None:
+            self._closed_cb(None)
+
+    def _failed(self, error):
+        if self._closed:
+            return
+        self.close()
+        if self._closed_cb is not None:
+            self._closed_cb(error)
+
+def _align(offset, alignment):
+    return (offset + alignment - 1) & ~(alignment - 1)
+
+def _dbus_message_length(data):
+    """
+    Return the length of the D-Bus message at the start of data, or None if
+    data does not hold its whole fixed header yet.
+    """
+    if len(data) < 16:
+        return None
+    if data[0] == 'l':
+        fmt = '<I'
+    elif data[0] == 'B':
+        fmt = '>I'
+    else:
+        raise ValueError('invalid D-Bus message endianness %r' % data[0])
+    (body_length,) = struct.unpack(fmt, data[4:8])
+    (fields_length,) = struct.unpack(fmt, data[12:16])
+    length = _align(16 + fields_length, 8) + body_length
+    if length > _DBUS_MAXIMUM_MESSAGE_LENGTH:
+        # don't wait for, or buffer, more than any valid message
+        raise ValueError('D-Bus message of %d bytes is too long' % length)
+    return length
+
+def _dbus_header_fields(message):
+    """
+    Parse the header fields of a whole D-Bus message. Return the byte order
+    format character, a dict of the values of the string fields and a list
+    of (code, start, end) for the marshalled fields.
+    """
+    if message[0] == 'l':
+        order = '<'
+    else:
+        order = '>'
+    (fields_length,) = struct.unpack(order + 'I', message[12:16])
+    end = 16 + fields_length
+
+    values = {}
+    spans = []
+    pos = 16
+    while pos < end:
+        start = pos
+        code = ord(message[pos])
+        signature_length = ord(message[pos + 1])
+        signature = message[pos + 2:pos + 2 + signature_length]
+        pos += 3 + signature_length
+        if signature in ('s', 'o'):
+            pos = _align(pos, 4)
+            (length,) = struct.unpack(order + 'I', message[pos:pos + 4])
+            values[code] = message[pos + 4:pos + 4 + length]
+            pos += 5 + length
+        elif signature == 'g':
+            length = ord(message[pos])
+            values[code] = message[pos + 1:pos + 1 + length]
+            pos += 2 + length
+        elif signature in _DBUS_FIXED_SIZES:
+            size = _DBUS_FIXED_SIZES[signature]
+            pos = _align(pos, size) + size
+        else:
+            raise ValueError('unexpected type %r of D-Bus header field %d'
+                % (signature, code))
+        spans.append((code, start, pos))
+        pos = _align(pos, 8)
+
+    if spans and spans[-1][2] > end:
+        raise ValueError('truncated D-Bus message header')
+    return order, values, spans
+
+def _dbus_set_sender(message, sender):
+    """Return message with its sender header field set to sender."""
+    if isinstance(sender, unicode):
+        sender = sender.encode('utf-8')
+    order, values, spans = _dbus_header_fields(message)
+    (fields_length,) = struct.unpack(order + 'I', message[12:16])
+    body_start = _align(16 + fields_length, 8)
+
+    fields = []
+    length = 0
+    for code, start, end in spans:
+        if code == _DBUS_HEADER_FIELD_SENDER:
+            continue
+        padding = _align(length, 8) - length
+        fields.append('\0' * padding)
+        fields.append(message[start:end])
+        length += padding + end - start
+    padding = _align(length, 8) - length
+    fields.append('\0' * padding)
+    field = struct.pack(order + 'BBcxI', _DBUS_HEADER_FIELD_SENDER, 1, 's',
+        len(sender)) + sender + '\0'
+    fields.append(field)
+    length += padding + len(field)
+    fields.append('\0' * (_align(length, 8) - length))
+
+    return ''.join([message[:12], struct.pack(order + 'I', length)] +
+        fields + [message[body_start:]])
+
+def _peer_uid(sock):
+    if _SO_PEERCRED is None:
+        return None
+    try:
+        creds = sock.getsockopt(socket.SOL_SOCKET, _SO_PEERCRED,
+            struct.calcsize('3i'))
+    except socket.error:
+        return None
+    pid, uid, gid = struct.unpack('3i', creds)
+    return uid
+
+class DBusTubeMultiplexer(object):
+    """
+    Carries the private bus of a D-Bus tube between the application's
+    connection to the tube's socket and one protocol stream shared by all
+    the participants.
+
+    local is the non-blocking socket of the application's connection. The
+    connection manager acts as its D-Bus peer: it answers the
+    authentication (only EXTERNAL, for the user running the connection
+    manager, if require_credentials is True) and then splits what the
+    application sends into messages.
+
+    The messages are packed whole into frames of up to max_frame_size
+    bytes, which are passed to send_frame_cb(destination, frame), where
+    destination is the unique name the messages are addressed to, or None
+    for messages to all the participants. A frame is sent once the next
+    message would not fit in it or has another destination, or latency
+    milliseconds after its first message was queued, so a burst of small
+    messages costs one protocol round-trip rather than one each. The
+    messages are never reordered.
+
+    Frames received from the other participants are passed to deliver(),
+    which writes their messages to the application. When the application
+    disconnects or the connection fails, local is closed and
+    closed_cb(None or the error) is called.
+    """
+
+    def __init__(self, local, send_frame_cb, closed_cb=None,
+                 require_credentials=True,
+                 max_frame_size=DBUS_TUBE_MAX_FRAME_SIZE,
+                 latency=DBUS_TUBE_FRAME_LATENCY):
+        self._local = local
+        self._send_frame_cb = send_frame_cb
+        self._closed_cb = closed_cb
+        self._require_credentials = require_credentials
+        self._max_frame_size = max_frame_size
+        self._latency = latency
+        self._guid = os.urandom(16).encode('hex')
+
+        # what has been read from local and not handled yet, and the length
+        # it must reach before being worth handling
+        self._input = []
+        self._input_length = 0
+        self._needed = 1
+        self._authenticated = False
+        self._nul_received = False
+
+        # strings to write to local, the first one from self._offset, and
+        # messages delivered before the application authenticated
+        self._output = deque()
+        self._offset = 0
+        self._delayed = []
+
+        # the messages of the frame being put together
+        self._frame = []
+        self._frame_size = 0
+        self._frame_destination = None
+        self._flush_id = None
+
+        self._read_id = None
+        self._write_id = None
+        self._closed = False
+
+    def start(self):
+        """Start talking to the application."""
+        self._read_id = gobject.io_add_watch(self._local,
+            gobject.IO_IN | gobject.IO_HUP | gobject.IO_ERR, self._read_cb)
+
+    def deliver(self, frame, sender=None):
+        """
+        Write the messages of a frame from another participant to the
+        application, setting their sender to the unique name sender if it
+        is given.
+        """
+        messages = []
+        try:
+            while frame:
+                length = _dbus_message_length(frame)
+                if length is None or length > len(frame):
+                    raise ValueError('truncated D-Bus message')
+                message = frame[:length]
+                frame = frame[length:]
+                if sender is not None:
+                    message = _dbus_set_sender(message, sender)
+                messages.append(message)
+        except (ValueError, struct.error), e:
+            logger.warning('dropping the rest of a malformed D-Bus tube '
+                'frame: %s', e)
+
+        if self._authenticated:
+            self._write(messages)
+        else:
+            self._delayed.extend(messages)
+
+    def flush(self):
+        """Send the frame being put together now, if there is one."""
+        if self._flush_id is not None:
+            gobject.source_remove(self._flush_id)
+            self._flush_id = None
+        if self._frame:
+            frame = ''.join(self._frame)
+            destination = self._frame_destination
+            self._frame = []
+            self._frame_size = 0
+            self._frame_destination = None
+            self._send_frame_cb(destination, frame)
+
+    def _flush_cb(self):
+        self._flush_id = None
+        self.flush()
+        return False
+
+    def _queue_message(self, destination, message):
+        if self._frame and (destination != self._frame_destination or
+                self._frame_size + len(message) > self._max_frame_size):
+            self.flush()
+
+        self._frame.append(message)
+        self._frame_size += len(message)
+        self._frame_destination = destination
+
+        if self._frame_size >= self._max_frame_size:
+            self.flush()
+        elif self._flush_id is None:
+            if self._latency:
+                self._flush_id = gobject.timeout_add(self._latency,
+                    self._flush_cb)
+            else:
+                self._flush_id = gobject.idle_add(self._flush_cb)
+
+    def _read_cb(self, source, condition):
+        try:
+            data = self._local.recv(RELAY_READ_SIZE)
+        except socket.error, e:
+            if _would_block(e):
+                return True
+            self._read_id = None
+            self._failed(e)
+            return False
+
+        if not data:
+            self._read_id = None
+            self.flush()
+            self._failed(None)
+            return False
+
+        self._input.append(data)
+        self._input_length += len(data)
+        if self._input_length < self._needed:
+            return True
+
+        data = ''.join(self._input)
+        try:
+            if not self._authenticated:
+                data = self._authenticate(data)
+            if self._authenticated:
+                data = self._split(data)
+        except (ValueError, struct.error), e:
+            self._read_id = None
+            self._failed(e)
+            return False
+
+        if self._closed:
+            self._read_id = None
+            return False
+
+        if data:
+            self._input = [data]
+        else:
+            self._input = []
+        self._input_length = len(data)
+        return True
+
+    def _authenticate(self, data):
+        if not self._nul_received:
+            if data[0] != '\0':
+                raise ValueError('the client did not send the credentials '
+                    'byte')
+            if self._require_credentials and \
+                    _peer_uid(self._local) not in (None, os.getuid()):
+                raise ValueError('connection from another user')
+            self._nul_received = True
+            data = data[1:]
+
+        while not self._authenticated:
+            end = data.find('\r\n')
+            if end < 0:
+                if len(data) > 16384:
+                    raise ValueError('authentication line too long')
+                self._needed = len(data) + 1
+                return data
+            line = data[:end].split()
+            data = data[end + 2:]
+
+            if self._require_credentials:
+                mechanisms = 'EXTERNAL'
+            else:
+                mechanisms = 'EXTERNAL ANONYMOUS'
+
+            if not line:
+                reply = 'ERROR'
+            elif line[0] == 'AUTH':
+                if len(line) > 1 and line[1] == 'EXTERNAL':
+                    if self._require_credentials and (len(line) < 3 or
+                            line[2] != str(os.getuid()).encode('hex')):
+                        reply = 'REJECTED ' + mechanisms
+                    else:
+                        reply = 'OK ' + self._guid
+                elif len(line) > 1 and line[1] == 'ANONYMOUS' and \
+                        not self._require_credentials:
+                    reply = 'OK ' + self._guid
+                else:
+                    reply = 'REJECTED ' + mechanisms
+            elif line[0] == 'BEGIN':
+                self._authenticated = True
+                self._needed = 16
+                delayed = self._delayed
+                self._delayed = []
+                self._write(delayed)
+                return data
+            elif line[0] == 'CANCEL' or line[0] == 'ERROR':
+                reply = 'REJECTED ' + mechanisms
+            else:
+                # including NEGOTIATE_UNIX_FD, as file descriptors can't be
+                # passed over the protocol
+                reply = 'ERROR'
+            self._write([reply + '\r\n'])
+
+        return data
+
+    def _split(self, data):
+        while True:
+            length = _dbus_message_length(data)
+            if length is None or length > len(data):
+                if length is None:
+                    self._needed = 16
+                else:
+                    self._needed = length
+                return data
+
+            message = data[:length]
+            data = data[length:]
+            order, values, spans = _dbus_header_fields(message)
+            self._queue_message(
+                values.get(_DBUS_HEADER_FIELD_DESTINATION), message)
+
+    def _write(self, strings):
+        if self._closed or not strings:
+            return
+        # one write for the whole frame
+        self._output.append(''.join(strings))
+        if self._write_id is None:
+            self._write_id = gobject.io_add_watch(self._local,
+                gobject.IO_OUT | gobject.IO_HUP | gobject.IO_ERR,
+                self._write_cb)
+
+    def _write_cb(self, source, condition):
+        output = self._output
+        while output:
+            chunk = output[0]
+            try:
+                sent = self._local.send(buffer(chunk, self._offset))
+            except socket.error, e:
+                if _would_block(e):
+                    return True
+                self._write_id = None
+                self._failed(e)
+                return False
+
+            self._offset += sent
+            if self._offset < len(chunk):
+                return True
+            output.popleft()
+            self._offset = 0
+
+        self._write_id = None
+        return False
+
+    def close(self):
+        """
+        Stop talking to the application and close its connection, without
+        calling closed_cb. Messages waiting in a frame are dropped.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for id in (self._read_id, self._write_id, self._flush_id):
+            if id is not None:
+                gobject.source_remove(id)
+        self._read_id = None
+        self._write_id = None
+        self._flush_id = None
+        self._frame = []
+        self._frame_size = 0
+        self._local.close()
+
+    def _failed(self, error):
+        if self._closed:
+            return
+        self.close()
+        if self._closed_cb is not None:
+            self._closed_cb(error)
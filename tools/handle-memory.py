@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+Measure the memory used per handle by the connection's handle storage,
+before and after Handle was made a slotted object kept in a
+HandleRepository.
+
+"before" is the old Handle class, with an instance __dict__, stored in the
+weakref.WeakValueDictionary that Connection used to keep its handles in;
+"after" is telepathy.server.handle as it is now. The sizes are those
+reported by sys.getsizeof(), so this needs Python 2.6 or later; the id and
+name objects, which are the same in both cases, are not counted.
+
+Usage: handle-memory.py [number of handles]
+
+With CPython 2.7.18 on x86_64 Linux, the default 100000 handles give:
+
+    100000 contact handles, bytes per handle:
+               handle  indexes    total
+    before      344.0    158.9    502.9
+    after        80.0    229.8    309.8
+
+The indexes grow, as there is one name table per handle type on top of
+the table of handles by id, but the handles themselves shrink by more.
+The index figures depend on how full the dicts are after their last
+resize, so they vary with the number of handles and the Python build.
+"""
+
+import os
+import sys
+import weakref
+
+# telepathy.server.handle only needs weakref, so load it straight from the
+# source tree rather than from an installed (and possibly older) package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src', 'server'))
+from handle import Handle, HandleRepository
+
+HANDLE_TYPE_CONTACT = 1
+
+class OldHandle(object):
+    def __init__(self, id, handle_type, name):
+        self._id = id
+        self._type = handle_type
+        self._name = name
+
+def object_size(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+def measure_old(names):
+    handles = []
+    storage = weakref.WeakValueDictionary()
+    for i, name in names:
+        handle = OldHandle(i, HANDLE_TYPE_CONTACT, name)
+        handles.append(handle)
+        storage[HANDLE_TYPE_CONTACT, i] = handle
+
+    objects = 0
+    for handle in handles:
+        objects += object_size(handle)
+    indexes = sys.getsizeof(storage.data)
+    for ref in storage.data.itervalues():
+        indexes += sys.getsizeof(ref)
+    return objects, indexes
+
+def measure_new(names):
+    handles = []
+    storage = HandleRepository()
+    for i, name in names:
+        handle = Handle(i, HANDLE_TYPE_CONTACT,
+                        storage.intern_name(HANDLE_TYPE_CONTACT, name))
+        handles.append(handle)
+        storage[HANDLE_TYPE_CONTACT, i] = handle
+
+    objects = 0
+    for handle in handles:
+        objects += object_size(handle)
+    indexes = sys.getsizeof(storage._by_id)
+    for ref in storage._by_id.itervalues():
+        indexes += sys.getsizeof(ref)
+    indexes += sys.getsizeof(storage._by_name)
+    for names in storage._by_name.itervalues():
+        indexes += sys.getsizeof(names)
+    return objects, indexes
+
+def main():
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    else:
+        count = 100000
+
+    names = [(i, u'contact%d@example.com' % i)
+             for i in xrange(1, count + 1)]
+
+    print '%d contact handles, bytes per handle:' % count
+    print '%-8s %8s %8s %8s' % ('', 'handle', 'indexes', 'total')
+    for label, measure in (('before', measure_old), ('after', measure_new)):
+        objects, indexes = measure(names)
+        print '%-8s %8.1f %8.1f %8.1f' % (label, float(objects) / count,
+            float(indexes) / count, float(objects + indexes) / count)
+
+if __name__ == '__main__':
+    main()